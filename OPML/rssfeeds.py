@@ -21,13 +21,19 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 # Import from the Standard Library
-from copy import deepcopy
+from cPickle import dumps, loads, HIGHEST_PROTOCOL
 from datetime import datetime, timedelta
-from operator import itemgetter
+from hashlib import md5
+from operator import attrgetter, itemgetter
+from os import makedirs, rename, stat
+from os.path import dirname, exists, join
+from Queue import Queue, Empty
+from threading import Event, Lock, Thread
+from time import sleep, time
 from traceback import format_exc
 import re
-import socket
 import urllib2
+import zlib
 
 # Import from itools
 from itools import __version__ as itools_version
@@ -36,13 +42,13 @@ from itools.csv import CSVFile
 from itools.datatypes import Boolean, Integer, URI, Unicode, String, HTTPDate
 from itools.datatypes import Decimal, XMLContent
 from itools.gettext import MSG
-from itools.html import HTMLParser, sanitize_stream
-from itools.i18n.locale_ import format_date
+from itools.html import HTMLParser, sanitize_stream, stream_to_str_as_xhtml
+from itools.i18n.locale_ import format_date, format_datetime
 from itools.log import log_warning
 from itools.rss import RSSFile
 from itools.stl import stl, set_prefix
 from itools.uri import get_reference
-from itools.web import BaseView, INFO, ERROR, STLView
+from itools.web import BaseView, INFO, ERROR, STLView, get_context
 from itools.xml import XMLParser, stream_to_str, XMLError
 
 # Import from ikaaro
@@ -53,12 +59,318 @@ from ikaaro.text_views import CSV_View as BaseCSV_View, CSV_EditRow, CSV_AddRow
 from ikaaro.views_new import NewInstance
 
 # Import from itws
+from itws.utils import get_request_cache
 from itws.views import FieldsAutomaticEditView
 
 
 
 rss_default_pub_date = datetime(1970, 1, 1)
 
+
+
+class Article(object):
+    """An aggregated article, the description is the sanitized XHTML
+    (serialized) and the channel is shared by the articles of a feed.
+    """
+
+    __slots__ = ['title', 'link', 'pubDate', 'pubDate_valid', 'description',
+                 'channel', 'anchor', 'reverse_anchor']
+
+    def __init__(self, title, link, pubDate, pubDate_valid, description,
+                 channel):
+        self.title = title
+        self.link = link
+        self.pubDate = pubDate
+        self.pubDate_valid = pubDate_valid
+        self.description = description
+        self.channel = channel
+        self.anchor = None
+        self.reverse_anchor = None
+
+
+    def copy(self):
+        return Article(self.title, self.link, self.pubDate,
+                       self.pubDate_valid, self.description, self.channel)
+
+
+    def get_namespace(self, accept):
+        return {'title': self.title,
+                'link': self.link,
+                'pubDate': self.pubDate,
+                'pubDate_valid': self.pubDate_valid,
+                'formated_pubDate': format_date(self.pubDate, accept),
+                'description': XMLParser(self.description),
+                'channel': self.channel,
+                'anchor': self.anchor,
+                'reverse_anchor': self.reverse_anchor}
+
+
+def download_feed(uri, timeout, validators=None):
+    """Download the given feed, return the data and the validators of the
+    response (ETag, Last-Modified). If validators are given, the request
+    is conditional and the data is None if the feed was not modified.
+    """
+    # TODO Use itools.vfs instead of urllib2
+    req = urllib2.Request(uri)
+    req.add_header('User-Agent', 'itools/%s' % itools_version)
+    if validators:
+        etag, last_modified = validators
+        if etag:
+            req.add_header('If-None-Match', etag)
+        if last_modified:
+            req.add_header('If-Modified-Since', last_modified)
+    # The timeout is given to the socket of this request only
+    try:
+        response = urllib2.urlopen(req, timeout=timeout)
+    except urllib2.HTTPError, e:
+        if validators and e.code == 304:
+            return None, validators
+        raise
+    headers = response.info()
+    validators = (headers.get('ETag'), headers.get('Last-Modified'))
+    return response.read(), validators
+
+
+
+def download_feeds(uris, timeout, deadline, workers, validators={}):
+    """Download the given feeds concurrently, with at most "workers"
+    threads. Return {uri: (data, validators, error, traceback)}, the
+    feeds not downloaded before the deadline (in seconds) are in error.
+    See download_feed for the validators.
+    """
+    results = {}
+    queue = Queue()
+    for uri in uris:
+        queue.put(uri)
+    end = time() + deadline
+
+    def worker():
+        while True:
+            try:
+                uri = queue.get_nowait()
+            except Empty:
+                return
+            if time() > end:
+                continue
+            try:
+                data, uri_validators = download_feed(uri, timeout,
+                                                     validators.get(uri))
+            except Exception, e:
+                results[uri] = (None, None, e, format_exc())
+            else:
+                results[uri] = (data, uri_validators, None, None)
+
+    threads = [ Thread(target=worker)
+                for x in range(min(workers, len(uris))) ]
+    for thread in threads:
+        # Do not keep the server alive for a late download
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join(max(end - time(), 0))
+
+    # Copy, the late threads may still write their result
+    results = dict(results)
+    for uri in uris:
+        if uri not in results:
+            error = 'Deadline of %ss exceeded' % deadline
+            results[uri] = (None, None, error, error)
+    return results
+
+
+def get_error_message(error):
+    """Return the message of the given error (exception or string) as
+    unicode.
+    """
+    if isinstance(error, str):
+        return error.decode('utf-8', 'replace')
+    try:
+        return unicode(error)
+    except UnicodeError:
+        return str(error).decode('utf-8', 'replace')
+
+
+keywords_matchers = {}
+def get_keywords_matcher(keywords):
+    """Return the keywords (regular expressions) of a CSV row compiled in
+    one regular expression, matching if one of them matches.
+    """
+    keywords = tuple(keywords)
+    matcher = keywords_matchers.get(keywords)
+    if matcher is None:
+        if len(keywords_matchers) > 1000:
+            keywords_matchers.clear()
+        pattern = '|'.join([ '(?:%s)' % keyword for keyword in keywords ])
+        matcher = re.compile(pattern)
+        keywords_matchers[keywords] = matcher
+    return matcher
+
+
+
+class RssFeedsRefresher(object):
+    """Keep the aggregators warm: update their feeds in background threads
+    on their TTL schedule, the requests get the last articles at once,
+    even when they are stale.
+
+    The threads never touch the database: the requests register what to
+    update (see RssFeeds.get_update_job), the threads download, parse and
+    merge the feeds (see RssFeeds.run_update), and the next request on the
+    aggregator swaps the new articles (see RssFeeds.apply_update).
+    """
+
+    # Seconds between two checks of the aggregators
+    interval = 60
+    # Forget the aggregators nobody viewed for this time
+    expire_delta = timedelta(days=1)
+
+    def __init__(self):
+        self.lock = Lock()
+        # {abspath: {'update', 'job', 'next_time', 'view_time',
+        #            'start_time', 'event', 'result', 'error'}}
+        self.aggregators = {}
+        self.scheduler = None
+
+
+    def register(self, abspath, update, job, next_time):
+        """Called by the requests viewing the aggregator, "update(job)" is
+        called from the next time, outside of the request.
+        """
+        self.lock.acquire()
+        try:
+            aggregator = self.aggregators.get(abspath)
+            if aggregator is None:
+                aggregator = {'start_time': None, 'event': None,
+                              'result': None, 'error': None}
+                self.aggregators[abspath] = aggregator
+            aggregator['update'] = update
+            aggregator['job'] = job
+            aggregator['next_time'] = next_time
+            aggregator['view_time'] = datetime.now()
+            if self.scheduler is None:
+                self.scheduler = Thread(target=self.run)
+                self.scheduler.daemon = True
+                self.scheduler.start()
+        finally:
+            self.lock.release()
+
+
+    def run(self):
+        while True:
+            sleep(self.interval)
+            now = datetime.now()
+            self.lock.acquire()
+            try:
+                for abspath, aggregator in self.aggregators.items():
+                    if now - aggregator['view_time'] > self.expire_delta:
+                        # Not viewed for a while (or removed)
+                        if aggregator['start_time'] is None:
+                            del self.aggregators[abspath]
+                    elif aggregator['next_time'] <= now:
+                        self._start(abspath, aggregator)
+            finally:
+                self.lock.release()
+
+
+    def refresh(self, abspath):
+        """Update the given aggregator in a background thread, unless it is
+        already being updated.
+        """
+        self.lock.acquire()
+        try:
+            aggregator = self.aggregators.get(abspath)
+            if aggregator is not None:
+                self._start(abspath, aggregator)
+        finally:
+            self.lock.release()
+
+
+    def _start(self, abspath, aggregator):
+        # The lock is held
+        if aggregator['start_time'] is not None:
+            # Being updated
+            return
+        if aggregator['result'] is not None:
+            # Not applied yet
+            return
+        aggregator['start_time'] = datetime.now()
+        aggregator['event'] = Event()
+        thread = Thread(target=self._update, args=(abspath, aggregator,
+                        aggregator['update'], aggregator['job']))
+        thread.daemon = True
+        thread.start()
+
+
+    def _update(self, abspath, aggregator, update, job):
+        result = error = None
+        try:
+            result = (job, update(job))
+        except Exception:
+            details = format_exc()
+            error = (datetime.now(), details)
+            summary = ('rssfeeds, Error refreshing feeds\n'
+                       'path: %s\n\n' % abspath)
+            log_warning(summary + details, domain='itws')
+        self.lock.acquire()
+        try:
+            aggregator['result'] = result
+            aggregator['error'] = error
+            aggregator['start_time'] = None
+            if error is not None:
+                # Retry on the next TTL
+                aggregator['next_time'] = datetime.now() + job['ttl']
+            aggregator['event'].set()
+        finally:
+            self.lock.release()
+
+
+    def wait(self, abspath, timeout):
+        """Wait at most "timeout" seconds for the running update of the
+        given aggregator.
+        """
+        self.lock.acquire()
+        try:
+            aggregator = self.aggregators.get(abspath)
+            event = aggregator['event'] if aggregator else None
+        finally:
+            self.lock.release()
+        if event is not None:
+            event.wait(timeout)
+
+
+    def pop_result(self, abspath):
+        """Return the job and the state computed in background (see
+        RssFeeds.run_update) not applied yet, or None.
+        """
+        self.lock.acquire()
+        try:
+            aggregator = self.aggregators.get(abspath)
+            if aggregator is None:
+                return None
+            result = aggregator['result']
+            aggregator['result'] = None
+            return result
+        finally:
+            self.lock.release()
+
+
+    def get_state(self, abspath):
+        """Return the start time of the running update and the last error
+        (time, traceback), both can be None.
+        """
+        self.lock.acquire()
+        try:
+            aggregator = self.aggregators.get(abspath)
+            if aggregator is None:
+                return None, None
+            return aggregator['start_time'], aggregator['error']
+        finally:
+            self.lock.release()
+
+
+rss_refresher = RssFeedsRefresher()
+
+
+
 ######################################################################
 # Views
 ######################################################################
@@ -93,15 +405,14 @@ class RssFeeds_View(STLView):
         ac = resource.get_access_control()
         is_allowed_to_edit = ac.is_allowed_to_edit(context.user, resource)
         articles, errors = resource.get_articles()
+        # State of the background refresh
+        errors = list(errors or []) + resource.get_refresh_errors(context)
+        errors = [ XMLParser(error) for error in errors ]
         see_errors = is_allowed_to_edit and errors
 
         # Filter
         feed_filter = context.get_query_value('feed')
         feeds_cache = resource.get_summary()
-        if feeds_cache is None:
-            # XXX Sometime there is a bug with the cache
-            resource.update_rss()
-            feeds_cache = resource.get_summary()
 
         if feed_filter != 'all' and feed_filter in feeds_cache:
             feed = feeds_cache[feed_filter]
@@ -116,10 +427,8 @@ class RssFeeds_View(STLView):
             feed_filter = 'all'
 
         # sort by publication date
-        articles.sort(key=lambda x: x['pubDate'], reverse=True)
-        for article in articles:
-            article['formated_pubDate'] = format_date(article['pubDate'],
-                                                      accept)
+        articles = sorted(articles, key=attrgetter('pubDate'), reverse=True)
+        articles = [ article.get_namespace(accept) for article in articles ]
         # Filter
         feeds = []
         total_nb_articles = 0
@@ -178,11 +487,31 @@ class FeedRSS_OPML(BaseView):
 
 class CSV_View(BaseCSV_View):
 
+    def get_table_columns(self, resource, context):
+        columns = BaseCSV_View.get_table_columns(self, resource, context)
+        # The health of the feed, next to active
+        names = [ column[0] for column in columns ]
+        columns.insert(names.index('active') + 1, ('health', MSG(u'State')))
+        return columns
+
+
+    def get_item_value(self, resource, context, item, column):
+        if column == 'health':
+            uri = item[resource.handler.columns.index('uri')]
+            return resource.get_feed_health(uri)
+        return BaseCSV_View.get_item_value(self, resource, context, item,
+                                           column)
+
+
     def sort_and_batch(self, resource, context, items):
         # Sort
         sort_by = context.query['sort_by']
         reverse = context.query['reverse']
-        if sort_by:
+        if sort_by == 'health':
+            uri = resource.handler.columns.index('uri')
+            key = lambda x: resource.get_feed_health(x[uri])
+            items.sort(key=key, reverse=reverse)
+        elif sort_by:
             sort_by = resource.handler.columns.index(sort_by)
             items.sort(key=itemgetter(sort_by), reverse=reverse)
 
@@ -234,6 +563,12 @@ class RssFeedsFile(CSVFile):
     last_articles = None
     feeds_summary = None
     errors = None
+    # {uri: parsed feed, with the validators of the response}
+    last_feeds = None
+    # {uri: consecutive failures, retry time and last error}
+    feeds_health = None
+    # Modification time of the on-disk cache (see RssFeeds.load_cache)
+    cache_mtime = None
 
 
 
@@ -251,7 +586,21 @@ class RssFeeds(CSV):
     class_schema = merge_dicts(
             CSV.class_schema,
             TTL=Integer(source='metadata', default=15),
-            timeout=Decimal(source='metadata', default=1.0))
+            timeout=Decimal(source='metadata', default=1.0),
+            deadline=Decimal(source='metadata', default=10.0),
+            max_articles=Integer(source='metadata', default=500),
+            max_age=Integer(source='metadata', default=0))
+
+    # Number of feeds downloaded at the same time
+    download_workers = 8
+    # Skip a feed after this number of failures in a row (see
+    # get_feed_failure)
+    feed_max_failures = 3
+    feed_max_backoff = timedelta(days=1)
+    # Format of the on-disk cache (see save_cache)
+    cache_version = 2
+    # Seconds to wait for the first update of the articles
+    first_update_timeout = 5
 
     # Hide itws sidebar
     display_sidebar = False
@@ -265,7 +614,8 @@ class RssFeeds(CSV):
     export_to_opml = FeedRSS_OPML()
     configure = FieldsAutomaticEditView(
                     title=MSG(u'Configure'),
-                    edit_fields=['title', 'TTL', 'timeout'])
+                    edit_fields=['title', 'TTL', 'timeout', 'deadline',
+                                 'max_articles', 'max_age'])
 
     def get_columns(self):
         return [('uri', MSG(u'URL')),
@@ -273,163 +623,475 @@ class RssFeeds(CSV):
                 ('active', MSG(u'Active'))]
 
 
+    def get_feed_rows(self):
+        """Return the active feeds, as (uri, keywords) tuples.
+        """
+        rows = []
+        for uri, keywords, active in self.handler.get_rows():
+            if active is False:
+                continue
+            keywords = [x.strip().lower() for x in keywords.split(',')]
+            rows.append((uri, keywords))
+        return rows
+
+
+    def get_update_job(self):
+        """Return the update to run outside of the request (see
+        RssFeedsRefresher and run_update), only built of plain values: the
+        feeds, the settings and the state of the last update.
+        """
+        handler = self.handler
+        # The parsed feeds of the last update, by URI
+        last_feeds = handler.last_feeds or {}
+
+        # Conditional request if the keywords did not change
+        rows = self.get_feed_rows()
+        validators = {}
+        for uri, keywords in rows:
+            last_feed = last_feeds.get(uri)
+            if last_feed and last_feed['keywords'] == keywords:
+                validators[uri] = last_feed['validators']
+
+        return {'rows': rows,
+                'validators': validators,
+                'timeout': float(self.get_property('timeout')),
+                'deadline': float(self.get_property('deadline')),
+                'workers': self.download_workers,
+                'ttl': timedelta(minutes=self.get_property('TTL')),
+                'max_age': self.get_property('max_age'),
+                'max_articles': self.get_property('max_articles'),
+                'cache_path': self.get_cache_path(),
+                'last_download_time': handler.last_download_time,
+                'last_feeds': last_feeds,
+                'feeds_health': handler.feeds_health or {}}
+
+
     def update_rss(self):
+        """Update the articles at once, in the request.
+        """
+        self.set_state(self.run_update(self.get_update_job()))
+
+
+    def set_state(self, state):
+        """Replace the articles and the state of the feeds by the ones
+        computed by run_update (or loaded by load_cache).
+        """
         handler = self.handler
+        handler.last_download_time = state['last_download_time']
+        handler.last_articles = state['last_articles']
+        handler.errors = state['errors']
+        handler.feeds_summary = state['feeds_summary']
+        handler.last_feeds = state['last_feeds']
+        handler.feeds_health = state['feeds_health']
+        handler.cache_mtime = state['cache_mtime']
+
+
+    @classmethod
+    def run_update(cls, job):
+        """Download, parse and merge the feeds of the given job (see
+        get_update_job), save the on-disk cache and return the new state
+        (see set_state).  Called in a thread, does not use the database.
+        """
         errors = []
-        errors_str = []
         articles = []
         feeds_summary = {}
-        # backup the default timeout
-        default_timeout = socket.getdefaulttimeout()
-        socket.setdefaulttimeout(self.get_property('timeout'))
+        last_feeds = job['last_feeds']
+        new_feeds = {}
+        now = datetime.now()
 
-        # Download the feeds
-        for uri, keywords, active in handler.get_rows():
-            if active is False:
+        # Skip the feeds in failure until their retry time
+        last_feeds_health = job['feeds_health']
+        feeds_health = {}
+        uris = []
+        for uri, keywords in job['rows']:
+            health = last_feeds_health.get(uri)
+            if health is None:
+                uris.append(uri)
                 continue
-            keywords = [x.strip().lower() for x in keywords.split(',')]
+            feeds_health[uri] = health
+            if health['retry_time'] is None or health['retry_time'] < now:
+                uris.append(uri)
+                continue
+            msg = u'%s <br />-- Skipped until %s after %s failures: "%s"'
+            msg = msg % (XMLContent.encode(str(uri)),
+                         health['retry_time'].strftime('%Y-%m-%d %H:%M'),
+                         health['failures'],
+                         XMLContent.encode(health['error']))
+            errors.append(msg.encode('utf-8'))
+
+        downloads = download_feeds(uris, job['timeout'], job['deadline'],
+                                   job['workers'], job['validators'])
+
+        for uri, keywords in job['rows']:
+            # The last articles are kept while the feed is skipped or
+            # failing
+            last_feed = last_feeds.get(uri)
+            if last_feed and last_feed['keywords'] != keywords:
+                last_feed = None
+            if last_feed:
+                # The articles get new anchors
+                last_feed = merge_dicts(last_feed, articles=[
+                    article.copy() for article in last_feed['articles'] ])
+
+            feed = last_feed
+            if uri in downloads:
+                feed = cls.get_downloaded_feed(uri, keywords, downloads[uri],
+                                               last_feed, feeds_health,
+                                               errors, now, job)
+            if feed is None:
+                continue
+            new_feeds[uri] = feed
 
-            # TODO Use itools.vfs instead of urllib2
-            try:
-                req = urllib2.Request(uri)
-                req.add_header('User-Agent', 'itools/%s' % itools_version)
-                response = urllib2.urlopen(req)
-                data = response.read()
-            except (socket.error, socket.gaierror, Exception,
-                    urllib2.HTTPError), e:
-                msg = '%s <br />-- Network error: "%s"'
-                msg = msg % (XMLContent.encode(str(uri)), e)
-                msg = msg.encode('utf-8')
-                errors.append(XMLParser(msg))
-                errors_str.append(msg)
+            # The sanitize errors
+            errors.extend(feed['errors'])
 
-                summary = ('rssfeeds, Error downloading feed\n'
-                           'uri: %s\n\n' % str(uri))
-                details = format_exc()
+            feed_articles = feed['articles']
+            articles.extend(feed_articles)
+            # Generate the feed summary
+
+            title = feed['title']
+            if title is None:
+                # Channel is not well formed -> no attribute title
+                continue
+            feeds_summary[uri] = {'title': title,
+                                  'nb_articles': len(feed_articles),
+                                  'articles': feed_articles}
+
+        # Sort by publication date, evict the old articles
+        articles.sort(key=attrgetter('pubDate'), reverse=True)
+        articles = cls.evict_articles(articles, job['max_age'],
+                                      job['max_articles'])
+        kept = set([ id(article) for article in articles ])
+        for summary in feeds_summary.itervalues():
+            feed_articles = [ article for article in summary['articles']
+                              if id(article) in kept ]
+            summary['articles'] = feed_articles
+            summary['nb_articles'] = len(feed_articles)
+
+        # Add the anchors, once merged and sorted
+        for number, article in enumerate(articles):
+            article.anchor = 'anchor%d' % number
+            article.reverse_anchor = 'reverse_anchor%d' % number
+
+        state = {'last_download_time': datetime.now(),
+                 'last_articles': articles,
+                 'errors': errors,
+                 'feeds_summary': feeds_summary,
+                 'last_feeds': new_feeds,
+                 'feeds_health': feeds_health}
+        state['cache_mtime'] = cls.save_cache(job['cache_path'], state)
+        return state
+
+
+    @classmethod
+    def get_downloaded_feed(cls, uri, keywords, download, last_feed,
+                            feeds_health, errors, now, job):
+        """Return the parsed feed of the given download (see
+        download_feeds), or the last one if it failed.
+        """
+        data, uri_validators, e, details = download
+        if e is not None:
+            error = get_error_message(e)
+            msg = u'%s <br />-- Network error: "%s"'
+            msg = msg % (XMLContent.encode(str(uri)), XMLContent.encode(error))
+            errors.append(msg.encode('utf-8'))
+
+            health = cls.get_feed_failure(feeds_health.get(uri), error, now,
+                                          job['ttl'])
+            feeds_health[uri] = health
+            summary = ('rssfeeds, Error downloading feed (%s failures)\n'
+                       'uri: %s\n\n' % (health['failures'], str(uri)))
+            if health['failures'] == 1:
                 log_warning(summary + details, domain='itws')
+            else:
+                # The traceback was logged on the first failure
+                log_warning(summary + health['error'].encode('utf-8'),
+                            domain='itws')
+            return last_feed
+        # Ok
+        feeds_health.pop(uri, None)
+
+        if data is None:
+            # Not modified, reuse the parsed and sanitized articles
+            return last_feed
+
+        # Parse
+        try:
+            feed = RSSFile(string=data)
+        except Exception, e:
+            msg = u'%s <br />-- Error parsing: "%s"'
+            msg = msg % (XMLContent.encode(str(uri)),
+                         XMLContent.encode(get_error_message(e)))
+            errors.append(msg.encode('utf-8'))
+            summary = ('rssfeeds, Error parsing feed\n'
+                       'uri: %s\n\n' % str(uri))
+            details = format_exc()
+            log_warning(summary + details, domain='itws')
+            return last_feed
+        feed = cls.get_feed_articles(uri, feed, keywords, job['max_age'],
+                                     job['max_articles'])
+        feed['validators'] = uri_validators
+        return feed
+
+
+    @classmethod
+    def evict_articles(cls, articles, max_age, max_articles):
+        """Keep at most "max_articles" articles (sorted by publication
+        date), not older than "max_age" days (0 = no limit).
+        """
+        if max_age:
+            min_date = datetime.now() - timedelta(days=max_age)
+            articles = [ article for article in articles
+                         if article.pubDate_valid is False or
+                            article.pubDate.replace(tzinfo=None) >= min_date ]
+        if max_articles:
+            articles = articles[:max_articles]
+        return articles
+
+
+    @classmethod
+    def get_feed_failure(cls, health, error, now, ttl):
+        """Return the health of a feed after a new failure: once the feed
+        failed "feed_max_failures" times in a row, it is skipped for the
+        TTL, then twice the TTL, etc. (at most "feed_max_backoff").
+        """
+        failures = health['failures'] + 1 if health else 1
+        retry_time = None
+        if failures >= cls.feed_max_failures:
+            exponent = min(failures - cls.feed_max_failures, 10)
+            backoff = ttl * 2 ** exponent
+            retry_time = now + min(backoff, cls.feed_max_backoff)
+        return {'failures': failures,
+                'retry_time': retry_time,
+                'error': get_error_message(error)}
+
+
+    def get_feed_health(self, uri):
+        """Return the state of the given feed, as shown in CSV_View.
+        """
+        feeds_health = self.handler.feeds_health or {}
+        health = feeds_health.get(uri)
+        if health is None:
+            return MSG(u'OK').gettext()
+        retry_time = health['retry_time']
+        if retry_time is None or retry_time < datetime.now():
+            return MSG(u'Failing ({failures} failures)').gettext(
+                    failures=health['failures'])
+        retry_time = format_datetime(retry_time, get_context().accept_language)
+        return MSG(u'Skipped until {time} ({failures} failures)').gettext(
+                failures=health['failures'], time=retry_time)
+
+
+    @classmethod
+    def get_feed_articles(cls, uri, feed, keywords, max_age, max_articles):
+        """Return the well formed articles of the given feed (RSSFile)
+        matching the keywords, with the channel title and the errors.
+        """
+        # Check
+        matcher = get_keywords_matcher(keywords)
+        # Shared by the articles of the feed
+        channel = {'title': feed.channel.get('title'),
+                   'link': feed.channel.get('link')}
+        feed_articles = []
+        errors = []
+        uri_ref = get_reference(uri)
+        for item in feed.items:
+            # Check if description is available
+            description = item.get('description')
+            if description is None:
+                # Invalid item (not well formed)
+                continue
+            # Add the Article if correspond to keywords
+            title = item['title']
+            if not (matcher.search(title.lower()) or
+                    matcher.search(description.lower())):
                 continue
 
-            # Parse
+            # Check if the article is well formed
             try:
-                feed = RSSFile(string=data)
-            except Exception, e:
-                msg = '%s <br />-- Error parsing: "%s"'
-                msg = msg % (XMLContent.encode(str(uri)), e)
+                description = HTMLParser(description.encode('utf-8'))
+                description = sanitize_stream(description)
+                # Set prefix with the url of the feed
+                description = set_prefix(description, prefix='.', uri=uri_ref)
+                description = stream_to_str_as_xhtml(description)
+            except (XMLError, UnicodeDecodeError), e:
+                msg = u'%s <br />-- Error on article: "%s"<br />-- "%s"'
+                msg = msg % (XMLContent.encode(str(uri)),
+                             XMLContent.encode(get_error_message(e)),
+                             XMLContent.encode(title))
                 msg = msg.encode('utf-8')
-                errors.append(XMLParser(msg))
-                errors_str.append(msg)
-                summary = ('rssfeeds, Error parsing feed\n'
+                errors.append(msg)
+                summary = ('rssfeeds, Error sanitizing feed\n'
                            'uri: %s\n\n' % str(uri))
                 details = format_exc()
                 log_warning(summary + details, domain='itws')
                 continue
 
-            # Check
-            feed_articles = []
-            for item in feed.items:
-                # Check if description is available
-                if item.get('description') is None:
-                    # Invalid item (not well formed)
-                    continue
-                item['pubDate_valid'] = True
-                if not item.has_key('pubDate'):
-                    item['pubDate'] = rss_default_pub_date
-                    item['pubDate_valid'] = False
-                item['channel'] = feed.channel
-                # Add the Article if correspond to keywords
-                for keyword in keywords:
-                    if (re.search(keyword, item['title'].lower()) or
-                        re.search(keyword, item['description'].lower())):
-                        feed_articles.append(item)
-                        break
-
-            # Check if the articles are well formed
-            for article in feed_articles:
-                article['valid'] = True
-                description = article['description'].encode('utf-8')
-                try:
-                    description = HTMLParser(description)
-                    article['description'] = sanitize_stream(description)
-                except (XMLError, UnicodeDecodeError), e:
-                    article['valid'] = False
-                    msg = '%s <br />-- Error on article: "%s"<br />-- "%s"'
-                    msg = msg % (XMLContent.encode(str(uri)), e,
-                                 article['title'])
-                    msg = msg.encode('utf-8')
-                    errors.append(XMLParser(msg))
-                    errors_str.append(msg)
-                    summary = ('rssfeeds, Error sanitizing feed\n'
-                               'uri: %s\n\n' % str(uri))
-                    details = format_exc()
-                    log_warning(summary + details, domain='itws')
-
-            # Skip invalid articles
-            feed_articles = [ article for article in feed_articles
-                              if article['valid'] ]
-            articles.extend(feed_articles)
-            # Generate the feed summary
-
-            try:
-                feeds_summary[uri] = {'title': feed.channel['title'],
-                                      'nb_articles': len(feed_articles),
-                                      'articles': feed_articles}
-            except KeyError:
-                # Channel is not well formed -> no attribute title
-                continue
+            pub_date = item.get('pubDate')
+            article = Article(title, item.get('link'),
+                              pub_date or rss_default_pub_date,
+                              pub_date is not None, description, channel)
+            feed_articles.append(article)
+
+        # Evict the old articles
+        feed_articles.sort(key=attrgetter('pubDate'), reverse=True)
+        feed_articles = cls.evict_articles(feed_articles, max_age,
+                                           max_articles)
+        return {'keywords': keywords,
+                'title': channel['title'],
+                'articles': feed_articles,
+                'errors': errors}
+
+
+    def is_stale(self):
+        last_download_time = self.handler.last_download_time
+        if last_download_time is None:
+            return True
+        update_feeds_delta = timedelta(minutes=self.get_property('TTL'))
+        return datetime.now() - last_download_time > update_feeds_delta
+
+
+    ##########################################################################
+    # On-disk cache, shared by the processes of the instance
+    ##########################################################################
+    def get_cache_path(self):
+        # <instance>/cache/rssfeeds/<md5 of the resource path>
+        database = self.metadata.database
+        path = dirname(database.path.rstrip('/'))
+        name = md5(str(self.get_abspath())).hexdigest()
+        return join(path, 'cache', 'rssfeeds', name)
+
+
+    @classmethod
+    def save_cache(cls, path, state):
+        """Write the given state (see run_update) in the on-disk cache,
+        return its modification time.
+        """
+        data = merge_dicts(state, version=cls.cache_version)
+        del data['cache_mtime']
+        # The articles are shared by the summary and the feeds
+        data = zlib.compress(dumps(data, HIGHEST_PROTOCOL))
+        try:
+            if not exists(dirname(path)):
+                makedirs(dirname(path))
+            # Atomic for the readers
+            tmp_path = '%s.%s' % (path, md5(data).hexdigest())
+            with open(tmp_path, 'wb') as cache_file:
+                cache_file.write(data)
+            rename(tmp_path, path)
+            return stat(path).st_mtime
+        except (IOError, OSError):
+            log_warning('rssfeeds, Error saving cache\n\n%s' % format_exc(),
+                        domain='itws')
+            return None
+
+
+    def load_cache(self):
+        """Load the articles downloaded by another process (or before a
+        restart) if they are more recent than the ones in memory.
+        """
+        handler = self.handler
+        path = self.get_cache_path()
+        try:
+            mtime = stat(path).st_mtime
+        except OSError:
+            return
+        if mtime == handler.cache_mtime:
+            # Already loaded or saved by this process
+            return
+        try:
+            with open(path, 'rb') as cache_file:
+                data = loads(zlib.decompress(cache_file.read()))
+        except Exception:
+            log_warning('rssfeeds, Error loading cache\n\n%s' % format_exc(),
+                        domain='itws')
+            return
+        if data.get('version') != self.cache_version:
+            # Written by another version
+            return
+        data['cache_mtime'] = mtime
+        self.set_state(data)
+
+
+    def update_if_stale(self):
+        """Apply the feeds updated in background and start their update if
+        they are stale, once by request.
+        """
+        cache = get_request_cache(get_context())
+        key = str(self.get_abspath())
+        cache.get('RssFeeds.update_if_stale', key, self._update_if_stale)
+
+
+    def _update_if_stale(self):
+        handler = self.handler
+        abspath = str(self.get_abspath())
+        self.apply_update(rss_refresher.pop_result(abspath))
+        if self.is_stale():
+            # Maybe updated by another process
+            self.load_cache()
+
+        # What to update on the next TTL
+        ttl = timedelta(minutes=self.get_property('TTL'))
+        next_time = (handler.last_download_time or datetime.now()) + ttl
+        rss_refresher.register(abspath, self.run_update,
+                               self.get_update_job(), next_time)
+        if not self.is_stale():
+            return
+        # Send the cache, update in background
+        rss_refresher.refresh(abspath)
+        if handler.last_download_time is None:
+            # Nothing to send yet, wait for the update a little
+            rss_refresher.wait(abspath, self.first_update_timeout)
+            self.apply_update(rss_refresher.pop_result(abspath))
+
+
+    def apply_update(self, result):
+        """Swap the state computed in background (see RssFeedsRefresher),
+        unless the feeds were updated (by this process or another one) or
+        edited since.
+        """
+        if result is None:
+            return
+        job, state = result
+        if (job['last_download_time'] == self.handler.last_download_time
+            and job['rows'] == self.get_feed_rows()):
+            self.set_state(state)
+
+
+    def get_refresh_errors(self, context):
+        handler = self.handler
+        accept = context.accept_language
+        format = lambda x: format_datetime(x, accept).encode('utf-8')
 
-            # Add the anchors
-            uri_ref = get_reference(uri)
-            for number, article in enumerate(articles):
-                # Set prefix with url for article content
-                description = set_prefix(article['description'],
-                        prefix='.', uri=uri_ref)
-                # Transform generator into list
-                article['description'] = list(description)
-                # Anchor
-                article['anchor'] = 'anchor%d' % number
-                article['reverse_anchor'] = 'reverse_anchor%d' % number
-
-        # restore the default timeout
-        socket.setdefaulttimeout(default_timeout)
-
-        # Save informations
-        handler.last_download_time = datetime.now()
-        handler.last_articles = articles
-        list_errors = []
-        for index, x in enumerate(errors):
-            # FIXME (old comment 2010-12-27,
-            # the problem did not occurred since)
-            # if we simply append x (a generator) this cause a segfault in the
-            # xml parser
-            list_errors.append(x)
-
-        handler.errors = list_errors
-        handler.feeds_summary = feeds_summary
+        errors = []
+        abspath = str(self.get_abspath())
+        refresh_start_time, refresh_error = rss_refresher.get_state(abspath)
+        last_download_time = handler.last_download_time
+        if refresh_start_time is not None:
+            msg = 'The feeds are being refreshed (since %s)'
+            errors.append(msg % format(refresh_start_time))
+        elif last_download_time is not None and self.is_stale():
+            msg = 'The articles were downloaded on %s'
+            errors.append(msg % format(last_download_time))
+        if refresh_error is not None:
+            error_time, details = refresh_error
+            msg = 'The refresh failed on %s: "%s"'
+            msg = msg % (format(error_time), details.strip().splitlines()[-1])
+            errors.append(msg)
+        return [ XMLContent.encode(msg) for msg in errors ]
 
 
     def get_articles(self):
         # Download or send the cache ??
+        self.update_if_stale()
         handler = self.handler
-        now = datetime.now()
-        last_download_time = handler.last_download_time
-        update_feeds_delta = timedelta(minutes=self.get_property('TTL'))
-        if (last_download_time is None or
-            now - last_download_time > update_feeds_delta):
-            self.update_rss()
-        return handler.last_articles, handler.errors
+        return handler.last_articles or [], handler.errors
 
 
     def get_summary(self):
         # Download or send the cache ??
-        handler = self.handler
-        now = datetime.now()
-        last_download_time = handler.last_download_time
-        update_feeds_delta = timedelta(minutes=self.get_property('TTL'))
-        if (last_download_time is None or
-            now - last_download_time > update_feeds_delta):
-            self.update_rss()
-
-        return handler.feeds_summary
+        self.update_if_stale()
+        return self.handler.feeds_summary or {}
 
 
     def to_opml_stream(self, context):
@@ -450,10 +1112,8 @@ class RssFeeds(CSV):
         namespace['owner'] = owner
 
         # Feeds
-        articles, errors = self.get_articles()
-        feeds_cache = deepcopy(self.handler.feeds_summary)
         feeds = []
-        for uri, data in feeds_cache.iteritems():
+        for uri, data in self.get_summary().iteritems():
             feeds.append({'title': data['title'],
                           'nb_articles': data['nb_articles'],
                           'uri': uri,
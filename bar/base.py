@@ -57,12 +57,26 @@ class BoxAware(object):
     allow_instanciation = True
     # Hide in browse_content
     is_content = False
+    # How the rendered box varies (see Bar_View.get_box_stream): a tuple
+    # of 'here' (the current page), 'user' and 'language', () if it never
+    # varies, None if it must not be cached. The role of the user is
+    # always taken into account.
+    box_cache_vary = None
 
 
     def get_catalog_values(self):
         return {'box_aware': True}
 
 
+    def get_box_cache_vary(self):
+        return self.box_cache_vary
+
+
+    def get_box_cache_paths(self, context):
+        """Return the paths the rendered box depends on."""
+        return [self.get_canonical_path()]
+
+
     def get_specific_css(self):
         return self.get_property('specific_css')
 
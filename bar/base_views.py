@@ -31,10 +31,15 @@ from itools.web import get_context, STLView
 from ikaaro.views import CompositeView
 
 # Import from itws
-from itws.utils import get_admin_bar
+from itws.utils import FragmentCache, get_admin_bar, get_site_role
+from itws.utils import is_navigation_mode
 from itws.views import FieldsAutomaticEditView
 
 
+# Rendered boxes (see Bar_View.get_box_stream)
+boxes_cache = FragmentCache(size=2000)
+
+
 class Box_Edit(FieldsAutomaticEditView):
 
     @property
@@ -178,6 +183,55 @@ class Bar_View(CompositeView):
         return all_items
 
 
+    def get_box_cache_key(self, item, prefix, context):
+        """Return the key of the rendered box in the cache, None if it must
+        not be cached (see BoxAware.box_cache_vary).
+        """
+        get_vary = getattr(item, 'get_box_cache_vary', None)
+        vary = get_vary() if get_vary else None
+        if vary is None:
+            return None
+        # Role class (and edition mode for the admin links)
+        role = get_site_role(context)
+        edit_mode = None
+        if context.user is not None:
+            edit_mode = is_navigation_mode(context) is False
+        key = [item.class_id, context.uri.authority, str(item.get_abspath()),
+               prefix, role, edit_mode]
+        if 'here' in vary:
+            key.append(str(context.resource.get_abspath()))
+            key.append(context.view_name)
+        if 'user' in vary:
+            key.append(context.user and context.user.name)
+        if 'language' in vary:
+            site_root = context.site_root
+            languages = site_root.get_property('website_languages')
+            key.append(context.accept_language.select_language(languages))
+        return tuple(key)
+
+
+    def get_box_stream(self, view, item, prefix, context):
+        """Return the rendered box, with the links prefixed to be relative
+        to the current page, or None if the box is empty.
+        """
+        key = self.get_box_cache_key(item, prefix, context)
+        if key is not None:
+            value = boxes_cache.get(key)
+            if value is not None:
+                is_empty, events = value
+                return None if is_empty else events
+
+        stream = view.GET(item, context)
+        is_empty = view.get_view_is_empty()
+        events = None
+        if not is_empty:
+            events = list(set_prefix(stream, '%s/' % prefix))
+        if key is not None:
+            paths = item.get_box_cache_paths(context)
+            boxes_cache.set(key, (is_empty, events), paths)
+        return events
+
+
     def get_namespace(self, resource, context):
         here = context.resource
         # Build namespace
@@ -192,11 +246,10 @@ class Bar_View(CompositeView):
         views = []
         for view in self.subviews:
             item = view.item
-            stream = view.GET(item, context)
-            if view.get_view_is_empty():
-                continue
             prefix = here.get_pathto(item)
-            stream = set_prefix(stream, '%s/' % prefix)
+            stream = self.get_box_stream(view, item, prefix, context)
+            if stream is None:
+                continue
             css = self.boxes_css_class
             specific_css = item.get_specific_css()
             if specific_css:
@@ -387,6 +387,7 @@ class Diaporama(BoxAware, Folder):
     allow_instanciation = True
     is_contentbox = True
     is_sidebox = False
+    box_cache_vary = ('language',)
 
     edit_fields = freeze(['display_title'])
 
@@ -410,6 +411,13 @@ class Diaporama(BoxAware, Folder):
                            BoxAware.get_catalog_values(self))
 
 
+    def get_box_cache_paths(self, context):
+        # The images may be outside of the slideshow
+        table = self.get_resource(self.order_path)
+        return BoxAware.get_box_cache_paths(self, context) + \
+               list(table.get_links())
+
+
     ##############
     # Views
     ##############
@@ -150,21 +150,31 @@ class BoxFeed_View(Box_View, Details_View):
     def sort_and_batch(self, resource, context, results):
         root = context.root
         user = context.user
-        items = results.get_documents(sort_by=resource.get_property('sort_by'),
-                                      reverse=resource.get_property('reverse'),
-                                      start=0)
-        # Access Control (FIXME this should be done before batch)
-        allowed_items = []
-        nb_allowed = 0
+        sort_by = resource.get_property('sort_by')
+        reverse = resource.get_property('reverse')
         count = resource.get_property('count')
-        for item in items:
-            resource = root.get_resource(item.abspath)
-            ac = resource.get_access_control()
-            if ac.is_allowed_to_view(user, resource):
-                allowed_items.append((item, resource))
-                nb_allowed += 1
-                if nb_allowed == count:
-                    break
+        # Access Control
+        # The catalog already filtered the results by view state (see
+        # Feed_View.get_items), only check the specific ACL on the batch,
+        # get the next batch until "count" items are allowed
+        allowed_items = []
+        start = 0
+        while True:
+            items = results.get_documents(sort_by=sort_by, reverse=reverse,
+                                          start=start, size=count)
+            for item in items:
+                item_resource = root.get_resource(item.abspath)
+                ac = item_resource.get_access_control()
+                if ac.is_allowed_to_view(user, item_resource):
+                    allowed_items.append((item, item_resource))
+                    if len(allowed_items) == count:
+                        break
+            if not count or len(allowed_items) == count:
+                break
+            if len(items) < count:
+                # No more results
+                break
+            start += count
 
         # FIXME BoxView API
         allowed_to_edit = self.is_admin(resource, context)
@@ -237,6 +247,7 @@ class BoxFeed(Box):
     allow_instanciation = True
     is_sidebox = True
     is_contentbox = True
+    box_cache_vary = ('language',)
 
     # Automatic Edit View
     edit_fields = freeze(['title', 'display_title',
@@ -248,6 +259,10 @@ class BoxFeed(Box):
     # Views
     view = BoxFeed_View()
 
+
+    def get_box_cache_paths(self, context):
+        return self.view.get_fragment_cache_paths(self, context)
+
     ##########################################
     # Links API
     ##########################################
@@ -121,6 +121,7 @@ class HTMLContent(BoxAware, WebPage):
     allow_instanciation = True
     is_contentbox = True
     is_sidebox = True
+    box_cache_vary = ('language',)
 
 
     def get_catalog_values(self):
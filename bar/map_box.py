@@ -145,6 +145,7 @@ class MapBox(Box):
     allow_instanciation = True
     is_contentbox = True
     is_sidebox = True
+    box_cache_vary = ('language',)
 
     view = MapBox_View()
     edit = MapBox_Edit()
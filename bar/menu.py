@@ -256,6 +256,8 @@ class MenuSideBar(BoxAware, MenuFolder):
     # Configuration
     use_fancybox = False
     allow_instanciation = True
+    # The active item depends on the current page
+    box_cache_vary = ('here', 'language')
 
     # Views
     view = MenuSideBar_View()
@@ -269,3 +271,10 @@ class MenuSideBar(BoxAware, MenuFolder):
     def get_catalog_values(self):
         return merge_dicts(MenuFolder.get_catalog_values(self),
                            BoxAware.get_catalog_values(self))
+
+
+    def get_box_cache_paths(self, context):
+        # The items the user is not allowed to view are hidden
+        menu = self.get_resource('menu')
+        return BoxAware.get_box_cache_paths(self, context) + \
+               list(menu.get_links())
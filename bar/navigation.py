@@ -30,6 +30,7 @@ from ikaaro.utils import get_base_path_query
 from bar_aware import SideBarAware
 from base import Box
 from base_views import Box_View
+from itws.utils import is_in_path
 from itws.webpage import WebPage
 from section import Section
 
@@ -183,6 +184,27 @@ class BoxNavigation(Box):
 
     # Configuration
     is_contentbox = False
+    box_cache_vary = ('here', 'language')
 
     # Views
     view = BoxNavigation_View()
+
+
+    def get_box_cache_paths(self, context):
+        # The children of the root of the tree and of the folders down to
+        # the current page (see BoxNavigation_View.get_items)
+        if self.get_property('limit_to_current_folder'):
+            container = context.resource
+            if isinstance(container, SideBarAware) is False:
+                container = container.parent
+        else:
+            container = self.get_site_root()
+        container_path = str(container.get_canonical_path())
+        paths = [self.get_canonical_path()]
+        path = str(context.resource.get_canonical_path())
+        while is_in_path(path, container_path):
+            paths.append('%s/*' % path.rstrip('/'))
+            if path == container_path:
+                break
+            path = path.rsplit('/', 1)[0] or '/'
+        return paths
@@ -39,7 +39,7 @@ class BoxTags_View(Box_View):
 
     def _get_tags_folder(self, resource, context):
         site_root = resource.get_site_root()
-        return site_root.get_resource('tags')
+        return site_root.get_tags_folder()
 
 
     def get_namespace(self, resource, context):
@@ -103,3 +103,16 @@ class BoxTags(Box):
 
     # Views
     view = BoxTags_View()
+
+
+    def get_box_cache_vary(self):
+        if self.get_property('random'):
+            return None
+        return ('language',)
+
+
+    def get_box_cache_paths(self, context):
+        # The tags and the number of items by tag (the changes of the tagged
+        # resources evict their tags, see monkey_patch)
+        site_path = self.get_site_root().get_canonical_path()
+        return [self.get_canonical_path(), site_path.resolve_name('tags')]
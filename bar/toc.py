@@ -224,11 +224,22 @@ class BoxSectionChildrenToc(Box):
     # Box comfiguration
     edit_fields = freeze(['hide_if_only_one_item'])
     allow_instanciation = False
+    box_cache_vary = ('here', 'language')
 
     # Views
     view = BoxSectionChildrenTree_View()
 
 
+    def get_box_cache_paths(self, context):
+        from itws.bar import Section
+
+        # The tree of the top section
+        section = context._bar_aware
+        while isinstance(section.parent, Section):
+            section = section.parent
+        return [self.get_canonical_path(), section.get_canonical_path()]
+
+
 
 class ContentBoxSectionChildrenToc(Box):
 
@@ -246,6 +257,13 @@ class ContentBoxSectionChildrenToc(Box):
     allow_instanciation = False
     is_contentbox = True
     is_sidebox = False
+    box_cache_vary = ('here', 'language')
 
     # Views
     view = ContentBoxSectionChildrenToc_View()
+
+
+    def get_box_cache_paths(self, context):
+        # The children of the section
+        section = context._bar_aware
+        return [self.get_canonical_path(), section.get_canonical_path()]
@@ -18,7 +18,9 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 # Import from standard library
-from datetime import datetime
+from collections import OrderedDict
+from threading import Lock, Thread
+from time import time
 from traceback import format_exc
 import httplib
 import re
@@ -37,40 +39,185 @@ from itools.xml import XMLParser, XMLError
 # Import from itws
 from base import Box
 from base_views import Box_View
-from itws.utils import ResourceWithCache
+from itws.utils import DiskCacheStorage, ResourceWithCache
 
 
 
-def http_head(hostname, path):
+def http_head(hostname, path, timeout=3):
+    """Return True if the remote page exists, False if the server answers
+    with an error and None if it cannot be reached in "timeout" seconds
+    (the timeout applies to the connection and to each read).
+    """
     try:
-        conn = httplib.HTTPConnection(hostname)
-        conn.request("HEAD", path)
-        res = conn.getresponse()
-        conn.close()
+        conn = httplib.HTTPConnection(hostname, timeout=timeout)
+        try:
+            conn.request("HEAD", path)
+            res = conn.getresponse()
+        finally:
+            conn.close()
         return res.status == 200
-    except (socket.error, socket.gaierror, Exception,
+    except (socket.error, socket.gaierror, socket.timeout,
             httplib.HTTPException):
-        return False
-    return False
+        return None
+    except Exception:
+        log_warning('sidebar/twitter, Error checking %s%s\n%s'
+                    % (hostname, path, format_exc()), domain='itws')
+        return None
+
+
+
+class RemoteValidator(object):
+    """Check that remote pages exist (see http_head), the results are kept
+    by page so the edit forms do not wait for the remote servers:
+
+    - a known page is not checked again before "ttl" seconds;
+    - a page that could not be reached is checked again after
+      "error_ttl" seconds;
+    - check_later makes the check in a background thread, once by page;
+    - only the last "size" checked pages are kept.
+    """
+
+    timeout = 3
+    ttl = 3600
+    error_ttl = 300
+    size = 1000
+
+    def __init__(self):
+        # {(hostname, path): (time, status)}, least recently used first
+        self.results = OrderedDict()
+        self.pending = set()
+        self.lock = Lock()
+
+
+    def get_entry(self, hostname, path):
+        """Return the (time, status) of the last check of the page if it
+        has not expired, else None.
+        """
+        key = (hostname, path)
+        self.lock.acquire()
+        try:
+            entry = self.results.pop(key, None)
+            if entry is None:
+                return None
+            checked, status = entry
+            ttl = self.ttl if status is not None else self.error_ttl
+            if time() - checked > ttl:
+                return None
+            # Least recently used at the beginning
+            self.results[key] = entry
+            return entry
+        finally:
+            self.lock.release()
+
+
+    def get_status(self, hostname, path):
+        """Return the cached status of the page: True, False or None if it
+        is unknown (never checked, expired or unreachable).
+        """
+        entry = self.get_entry(hostname, path)
+        if entry is None:
+            return None
+        checked, status = entry
+        return status
+
+
+    def is_expired(self, hostname, path):
+        return self.get_entry(hostname, path) is None
+
+
+    def check(self, hostname, path):
+        status = http_head(hostname, path, self.timeout)
+        key = (hostname, path)
+        self.lock.acquire()
+        try:
+            self.results.pop(key, None)
+            self.results[key] = (time(), status)
+            while len(self.results) > self.size:
+                self.results.popitem(last=False)
+        finally:
+            self.lock.release()
+        return status
+
+
+    def _check_later(self, hostname, path):
+        try:
+            self.check(hostname, path)
+        finally:
+            self.lock.acquire()
+            try:
+                self.pending.discard((hostname, path))
+            finally:
+                self.lock.release()
+
+
+    def check_later(self, hostname, path):
+        key = (hostname, path)
+        self.lock.acquire()
+        try:
+            if key in self.pending:
+                return
+            self.pending.add(key)
+        finally:
+            self.lock.release()
+        thread = Thread(target=self._check_later, args=key)
+        thread.daemon = True
+        thread.start()
+
+
+remote_validator = RemoteValidator()
+
+
 
+class RemoteAccountMixin(object):
+    """The value is the name of an account on a remote service, it is valid
+    if the page given by "get_remote_page" exists.
 
-class TwitterID(Integer):
+    By default the page is checked when the form is submitted (the result
+    is cached, see RemoteValidator). With "validate_later" the value is
+    only refused if it is already known to be wrong, else it is checked
+    in the background and the box shows the status (see get_status).
+    """
+
+    validate_later = False
+
+    @classmethod
+    def is_valid(cls, value):
+        hostname, path = cls.get_remote_page(value)
+        status = remote_validator.get_status(hostname, path)
+        if cls.validate_later:
+            if remote_validator.is_expired(hostname, path):
+                remote_validator.check_later(hostname, path)
+            return status is not False
+        if status is None:
+            status = remote_validator.check(hostname, path)
+        return status is True
+
+
+    @classmethod
+    def get_status(cls, value):
+        """Return True, False or None if the status of the account is not
+        known yet (a check is started).
+        """
+        hostname, path = cls.get_remote_page(value)
+        if remote_validator.is_expired(hostname, path):
+            remote_validator.check_later(hostname, path)
+        return remote_validator.get_status(hostname, path)
+
+
+
+class TwitterID(RemoteAccountMixin, Integer):
 
     @staticmethod
-    def is_valid(value):
-        hostname = "twitter.com"
-        path = "/statuses/user_timeline/%s.rss" % value
-        return http_head(hostname, path)
+    def get_remote_page(value):
+        return "twitter.com", "/statuses/user_timeline/%s.rss" % value
 
 
 
-class IndenticaName(String):
+class IndenticaName(RemoteAccountMixin, String):
 
     @staticmethod
-    def is_valid(value):
-        hostname = "identi.ca"
-        path = "/%s" % value
-        return http_head(hostname, path)
+    def get_remote_page(value):
+        return "identi.ca", "/%s" % value
 
 
 
@@ -94,6 +241,15 @@ class TwitterSideBar_View(Box_View):
         is_allowed_to_edit = ac.is_allowed_to_edit(context.user, resource)
         namespace['items'] = items
         namespace['errors'] = is_allowed_to_edit and errors
+        namespace['account_error'] = None
+        if is_allowed_to_edit:
+            status = resource.get_account_status()
+            if status is False:
+                msg = MSG(u'The account has not been found.')
+                namespace['account_error'] = msg.gettext()
+            elif status is None:
+                msg = MSG(u'The account could not be checked yet.')
+                namespace['account_error'] = msg.gettext()
 
         if is_allowed_to_edit is False and (items is None or len(items) == 0):
             self.set_view_is_empty(True)
@@ -121,22 +277,41 @@ class TwitterSideBar(Box, ResourceWithCache):
     #http://www.webdesignerdepot.com/2009/07/50-free-and-exclusive-twitter-icons/
     class_schema = merge_dicts(Box.class_schema,
              force_update=Boolean(source='metadata'), # XXX Useless to delete
-             user_id=TwitterID(source='metadata',
+             user_id=TwitterID(source='metadata', validate_later=True,
                                title=MSG(u'User Id')),
              user_name=String(source='metadata',
                               title=MSG(u"Twitter account name")),
              limit=Integer(source='metadata',
-                           title=MSG(u"Number of tweets"), default=5))
+                           title=MSG(u"Number of tweets"), default=5),
+             cache_ttl=Integer(source='metadata',
+                               title=MSG(u'Refresh interval (in seconds)')))
 
 
     # Configuration
     allow_instanciation = True
-    edit_fields = freeze(['user_id', 'user_name', 'limit'])
+    edit_fields = freeze(['user_id', 'user_name', 'limit', 'cache_ttl'])
+
+    # Cache shared by the processes, the last entries in memory
+    cache_ttl = 300
+    cache_storage = DiskCacheStorage('sidebar-feeds', size=1000)
+    # The field checked by get_account_status
+    account_field = 'user_id'
 
     # Views
     view = TwitterSideBar_View()
 
 
+    def get_account_status(self):
+        """Return the status of the account from the cache of the remote
+        validation: True, False or None if it is not known yet.
+        """
+        value = self.get_property(self.account_field)
+        if not value:
+            return True
+        datatype = self.class_schema[self.account_field]
+        return datatype.get_status(value)
+
+
     def _get_account_uri(self):
         user_id = self.get_property('user_id')
         return 'http://twitter.com/statuses/user_timeline/%s.rss' % user_id
@@ -159,23 +334,23 @@ class TwitterSideBar(Box, ResourceWithCache):
         return list(self._transform_links(item['description']))
 
 
+    def get_update_arguments(self):
+        return self._get_account_uri(), self.get_property('limit')
+
+
     def _update_data(self):
-        limit = self.get_property('limit')
-        uri = self._get_account_uri()
+        uri, limit = self.update_arguments
         data = None
         # errors
         errors = []
         errors_str = []
 
-        # backup the default timeout
-        default_timeout = socket.getdefaulttimeout()
-        socket.setdefaulttimeout(3) # timeout in seconds
-
         # TODO Use itools.vfs instead of urllib2
         try:
             req = urllib2.Request(uri)
             req.add_header('User-Agent', 'itools/%s' % itools_version)
-            response = urllib2.urlopen(req)
+            # The timeout is given to the socket of this request only
+            response = urllib2.urlopen(req, timeout=3)
             data = response.read()
         except (socket.error, socket.gaierror, Exception,
                 urllib2.HTTPError, urllib2.URLError), e:
@@ -225,9 +400,6 @@ class TwitterSideBar(Box, ResourceWithCache):
                     else:
                         i += 1
 
-        # restore the default timeout
-        socket.setdefaulttimeout(default_timeout)
-
         # errors to display
         list_errors = []
         for index, x in enumerate(errors):
@@ -244,14 +416,8 @@ class TwitterSideBar(Box, ResourceWithCache):
                 continue
             #list_errors.append(x)
 
-        # Save informations only if there is no errors
-        metadata = self.metadata
-        first_update = metadata.cache_mtime is None
-        metadata.cache_mtime = datetime.now()
-        if first_update or (metadata.cache_errors is not None \
-                            and not list_errors):
-            metadata.cache_data = data
-            metadata.cache_errors = list_errors
+        # The last data is kept if there are errors (see ResourceWithCache)
+        return data, list_errors
 
 
 
@@ -264,17 +430,20 @@ class IdenticaSideBar(TwitterSideBar):
     class_icon48 = 'bar_items/icons/48x48/identica.png'
     class_schema = merge_dicts(Box.class_schema,
              force_update=Boolean(source='metadata'), # XXX Useless to delete
-             user_name=IndenticaName(source='metadata',
+             user_name=IndenticaName(source='metadata', validate_later=True,
                                      title=MSG(u'Identi.ca account name')),
              limit=Integer(source='metadata', mandatory=True, default=5,
-                           size=3, title=MSG(u'Number of messages')))
+                           size=3, title=MSG(u'Number of messages')),
+             cache_ttl=Integer(source='metadata',
+                               title=MSG(u'Refresh interval (in seconds)')))
 
     # identica icons source: http://status.net/
 
     # Item configuration
     allow_instanciation = True
 
-    edit_fields = freeze(['user_name', 'limit'])
+    edit_fields = freeze(['user_name', 'limit', 'cache_ttl'])
+    account_field = 'user_name'
 
     # Views
     view = IdenticaSideBar_View()
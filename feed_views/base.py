@@ -17,25 +17,36 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 # Import from itools
-from itools.core import merge_dicts
+from itools.core import freeze, merge_dicts
 from itools.database import AndQuery, NotQuery, PhraseQuery
 from itools.database import OrQuery, TextQuery
 from itools.datatypes import Integer, String, Boolean
+from itools.datatypes import XMLAttribute, XMLContent
 from itools.gettext import MSG
+from itools.uri import Path
 from itools.web import FormError
+from itools.xml import XMLParser
 
 # Import from ikaaro
 from ikaaro.buttons import Button
 from ikaaro.folder_views import Folder_BrowseContent
+from ikaaro.registry import get_resource_class
 from ikaaro.utils import get_base_path_query
 from ikaaro.website import WebSite
-from ikaaro.workflow import get_workflow_preview
+from ikaaro.workflow import WorkflowAware, get_workflow_preview
 
 # Import from itws
-from itws.utils import ITWS_Autoform, render_for_datatype
+from itws.utils import FragmentCache, ITWS_Autoform
+from itws.utils import get_allowed_to_view_query, get_request_cache
+from itws.utils import get_site_role, is_navigation_mode
+from itws.utils import render_for_datatype
 
 
 
+# Rendered Feed_View (see Feed_View.fragment_cache)
+feed_views_cache = FragmentCache()
+
+
 ###########################################
 # See bug:
 # http://bugs.hforge.org/show_bug.cgi?id=1100
@@ -106,6 +117,18 @@ class Feed_View(BrowseContent):
     # Get items configuration
     ignore_internal_resources = False
     ignore_box_aware = True
+    # Build the items from the catalog, the resources are only loaded for
+    # the columns which need them (the ACL is done by the catalog)
+    brain_only = False
+    # Keep the rendered view in cache for all the users with the same role,
+    # until a resource inside the container changes
+    fragment_cache = False
+    # Columns which only depend on the item, they are computed once by
+    # request (the same item can be displayed by several views)
+    request_cache_keys = freeze(['pub_datetime', 'title', 'long_title',
+                                 'link', 'abspath', 'is_image', 'image',
+                                 'tags', 'workflow_state', 'type',
+                                 'class_icon16', 'class_icon48'])
 
     # We save view_resource to allow to add @property methods
     # that get view configuration from a resource
@@ -226,6 +249,11 @@ class Feed_View(BrowseContent):
         if search_query:
             queries.extend(search_query)
 
+        # Access Control (done by the catalog, before the batch)
+        acl_query = get_allowed_to_view_query(context)
+        if acl_query is not None:
+            queries.append(acl_query)
+
         # Transform list of queries into a query
         if len(queries) == 1:
             query = queries[0]
@@ -235,6 +263,99 @@ class Feed_View(BrowseContent):
         # Search
         return root.search(query)
 
+    def sort_and_batch(self, resource, context, results):
+        if self.brain_only is False:
+            proxy = super(Feed_View, self)
+            return proxy.sort_and_batch(resource, context, results)
+
+        # The values are taken from the catalog
+        query = context.query
+        items = results.get_documents(sort_by=query['sort_by'],
+                                      reverse=query['reverse'],
+                                      start=query['batch_start'],
+                                      size=query['batch_size'])
+        return self.get_allowed_brains(context, items)
+
+
+    def get_allowed_brains(self, context, brains):
+        """Return the items of the given brains the user is allowed to
+        view, in brain_only mode.  The catalog already filtered them by
+        view state (see get_items), only the specific ACL are checked.
+        """
+        user = context.user
+        root = context.root
+        items = []
+        for brain in brains:
+            item_resource = root.get_resource(brain.abspath)
+            ac = item_resource.get_access_control()
+            if ac.is_allowed_to_view(user, item_resource):
+                items.append((brain, None))
+        return items
+
+
+    def get_item_resource(self, context, item):
+        """Return the resource of the item, the resource is loaded if
+        the item comes from sort_and_batch in brain_only mode.
+        """
+        item_brain, item_resource = item
+        if item_resource is None:
+            return context.root.get_resource(item_brain.abspath)
+        return item_resource
+
+    ###############################################
+    ## Fragment cache
+    ###############################################
+    def get_fragment_cache_key(self, resource, context):
+        # Normalized query and the other parameters (kept in the links)
+        query = context.query
+        schema = self.get_query_schema()
+        uri_query = [ (name, value)
+                      for name, value in context.uri.query.iteritems()
+                      if name not in schema ]
+        query = [ (name, tuple(value) if type(value) is list else value)
+                  for name, value in query.iteritems() ]
+        # Language
+        site_root = context.site_root
+        languages = site_root.get_property('website_languages')
+        language = context.accept_language.select_language(languages)
+        # Role class (and edition mode for the admin bars)
+        role = get_site_role(context)
+        edit_mode = None
+        if context.user is not None:
+            edit_mode = is_navigation_mode(context) is False
+
+        return (self.__class__, context.uri.authority, str(context.uri.path),
+                tuple(sorted(query)), tuple(sorted(uri_query)), language,
+                role, edit_mode)
+
+
+    def get_fragment_cache_paths(self, resource, context):
+        """Return the paths the rendered view depends on."""
+        container_path = self._get_container(resource,
+                                             context).get_canonical_path()
+        site_path = resource.get_site_root().get_canonical_path()
+        paths = [resource.get_canonical_path(), site_path.resolve_name('tags')]
+        # Any change in the website would evict the view: the items of the
+        # whole website are tagged, their changes evict the tags instead
+        # (see monkey_patch)
+        if container_path != site_path:
+            paths.append(container_path)
+        return paths
+
+
+    def GET(self, resource, context):
+        proxy = super(Feed_View, self)
+        if self.fragment_cache is False:
+            return proxy.GET(resource, context)
+
+        key = self.get_fragment_cache_key(resource, context)
+        events = feed_views_cache.get(key)
+        if events is None:
+            events = list(proxy.GET(resource, context))
+            paths = self.get_fragment_cache_paths(resource, context)
+            feed_views_cache.set(key, events, paths)
+        return events
+
     ###############################################
     ## CSS Class / ID
     ###############################################
@@ -329,10 +450,101 @@ class Feed_View(BrowseContent):
         return value
 
 
+    def get_brain_link(self, context, abspath):
+        # Same as context.get_link but from the catalog
+        site_root = context.site_root
+        return '/%s' % site_root.get_abspath().get_pathto(Path(abspath))
+
+
+    def get_brain_value(self, resource, context, brain, column):
+        """Return the value of the column from the catalog, used in
+        brain_only mode. Fallback to get_item_value with the resource
+        loaded if the column is not in the catalog.
+        """
+        from ikaaro.file import Image
+        from itws.tags import get_tags_namespace
+
+        item_cls = get_resource_class(brain.format)
+        if column == 'class_icon16':
+            return item_cls.get_class_icon()
+        elif column == 'class_icon48':
+            return item_cls.get_class_icon(size='48')
+        elif column == 'pub_datetime':
+            if brain.is_tagsaware and brain.pub_datetime:
+                return context.format_datetime(brain.pub_datetime)
+            return None
+        elif column == 'title':
+            return brain.title or unicode(brain.name)
+        elif column in ('format', 'type'):
+            return item_cls.class_title.gettext()
+        elif column == 'long_title':
+            if brain.is_tagsaware and brain.preview_title:
+                return brain.preview_title
+            return brain.title or unicode(brain.name)
+        elif column in ('link', 'abspath'):
+            return self.get_brain_link(context, brain.abspath)
+        elif column == 'preview' and brain.is_tagsaware:
+            return brain.preview_content
+        elif column == 'is_image':
+            return issubclass(item_cls, Image)
+        elif column == 'image':
+            if brain.is_tagsaware:
+                thumbnail = brain.preview_thumbnail
+                if thumbnail:
+                    return self.get_brain_link(context, thumbnail)
+            elif issubclass(item_cls, Image):
+                return self.get_brain_link(context, brain.abspath)
+            return None
+        elif column == 'tags':
+            if brain.is_tagsaware:
+                return get_tags_namespace(context.site_root, brain.tags,
+                                          context)
+            return []
+        elif column == 'last_author':
+            author = brain.last_author
+            return context.root.get_user_title(author) if author else None
+        elif column == 'css':
+            if brain.abspath == resource.abspath:
+                return 'active'
+            return None
+        elif column == 'workflow_state':
+            if not issubclass(item_cls, WorkflowAware):
+                return None
+            # Same as get_workflow_preview
+            statename = brain.view_state
+            state = item_cls.workflow.states[statename]
+            msg = state['title'].gettext().encode('utf-8')
+            state = ('<strong class="wf-%s" title="%s">%s</strong>'
+                     % (statename, XMLAttribute.encode(msg),
+                        XMLContent.encode(msg)))
+            return XMLParser(state)
+        # Load the resource
+        item = (brain, context.root.get_resource(brain.abspath))
+        return self.get_item_value(resource, context, item, column)
+
+
     def get_item_value(self, resource, context, item, column):
+        if column in self.request_cache_keys:
+            cache = get_request_cache(context)
+            # The values depend on the view and on the resource it is
+            # rendered for (e.g. the 'css' column)
+            key = (self.__class__, resource.abspath, str(item[0].abspath),
+                   column)
+            return cache.get('Feed_View.get_item_value', key,
+                             self._get_item_value, resource, context, item,
+                             column)
+        return self._get_item_value(resource, context, item, column)
+
+
+    def _get_item_value(self, resource, context, item, column):
         from ikaaro.file import Image
 
         item_brain, item_resource = item
+        if item_resource is None:
+            # brain_only
+            return self.get_brain_value(resource, context, item_brain,
+                                        column)
+
         if column == 'class_icon16':
             return item_resource.get_class_icon()
         elif column == 'class_icon48':
@@ -14,8 +14,12 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+# Import from the Standard Library
+from heapq import nsmallest
+
 # Import from itools
 from itools.core import merge_dicts
+from itools.database import AndQuery, NotQuery, PhraseQuery, RangeQuery
 from itools.datatypes import Integer, Boolean, String
 
 # Import from ikaaro
@@ -23,6 +27,34 @@ from ikaaro.folder_views import Folder_BrowseContent
 
 # Import from itws
 from base import Feed_View
+from itws.utils import get_request_cache
+
+
+def get_none_safe_key(value):
+    """Sort key of a value which may be None, sorted first as by Xapian
+    (None and datetimes are not comparable).
+    """
+    return (value is not None, value)
+
+
+
+class Reversible(object):
+    """Sort key which can be reversed, to use heapq.nsmallest as a
+    sort(reverse=True)
+    """
+
+    __slots__ = ['value', 'reverse']
+
+    def __init__(self, value, reverse):
+        self.value = value
+        self.reverse = reverse
+
+
+    def __lt__(self, other):
+        if self.reverse:
+            return other.value < self.value
+        return self.value < other.value
+
 
 
 class MultipleFeed_View(Feed_View):
@@ -33,6 +65,11 @@ class MultipleFeed_View(Feed_View):
     # Query suffix
     query_suffix = None
 
+    # The previous/next links give the first/last item of the batch as
+    # cursor (batch_before/batch_after), the next batch is searched from
+    # the sort value of the cursor, so the cost of a deep batch is flat
+    batch_cursor = True
+
     def _get_query_suffix(self):
         return self.query_suffix
 
@@ -69,7 +106,9 @@ class MultipleFeed_View(Feed_View):
         d = merge_dicts(Folder_BrowseContent.get_query_schema(self),
                 batch_size=Integer(default=self.batch_size),
                 sort_by=String(default=self.sort_by),
-                reverse=Boolean(default=self.reverse))
+                reverse=Boolean(default=self.reverse),
+                batch_after=String,
+                batch_before=String)
 
         query_suffix = self._get_query_suffix()
         if query_suffix is None:
@@ -81,33 +120,157 @@ class MultipleFeed_View(Feed_View):
         return prefixed_d
 
 
-    def sort_and_batch(self, resource, context, results):
-        user = context.user
-        root = context.root
+    def _get_cursor(self, resource, context, results, sort_by):
+        """Return the brain of the cursor and if the batch is after it,
+        or (None, None) to use the batch_start offset.
+        """
+        if self.batch_cursor is False or not sort_by:
+            return None, None
+        for name, after in (('batch_after', True), ('batch_before', False)):
+            abspath = self._get_query_value(resource, context, name)
+            if not abspath:
+                continue
+            cursor = results.search(PhraseQuery('abspath', abspath))
+            cursor = cursor.get_documents(size=1)
+            # Removed or invalid cursor, fallback to batch_start
+            if not cursor or getattr(cursor[0], sort_by, None) is None:
+                return None, None
+            return cursor[0], after
+        return None, None
+
+
+    def _get_key_documents(self, results, get_key, reverse, start, size,
+                           cursor, after):
+        """Custom but slower sort algorithm"""
+        key = get_key()
+        items = results.get_documents()
+        if cursor is None:
+            if size:
+                items = nsmallest(start + size, items,
+                                  key=lambda x: Reversible(key(x), reverse))
+                return items[start:]
+            items.sort(key=key, reverse=reverse)
+            return items[start:]
+
+        # Keyset, (key, abspath) is the sort order
+        forward = (after != reverse)
+        cursor_key = (get_none_safe_key(key(cursor)), cursor.abspath)
+        items = [ (get_none_safe_key(key(x)), x.abspath, x) for x in items ]
+        if forward:
+            items = [ x for x in items if x[:2] > cursor_key ]
+        else:
+            items = [ x for x in items if x[:2] < cursor_key ]
+        sort_key = lambda x: Reversible(x[:2], not forward)
+        if size:
+            items = nsmallest(size, items, key=sort_key)
+        else:
+            items.sort(key=sort_key)
+        items = [ x[2] for x in items ]
+        if not after:
+            items.reverse()
+        return items
+
+
+    def _get_keyset_documents(self, results, sort_by, reverse, size,
+                              cursor, after):
+        """Faster Xapian sort algorithm from the cursor, (sort value,
+        abspath) is the sort order.
+        """
+        value = getattr(cursor, sort_by)
+        abspath = cursor.abspath
+        # Search in the ascending order ?
+        forward = (after != reverse)
+        same_value = RangeQuery(sort_by, value, value)
+        if forward:
+            query = AndQuery(RangeQuery(sort_by, value, None),
+                             NotQuery(same_value))
+        else:
+            # Keep the items without value (sorted first)
+            query = NotQuery(RangeQuery(sort_by, value, None))
+
+        # Items with the same value as the cursor
+        items = results.search(same_value).get_documents()
+        if forward:
+            items = [ x for x in items if x.abspath > abspath ]
+        else:
+            items = [ x for x in items if x.abspath < abspath ]
+        items.sort(key=lambda x: x.abspath, reverse=not forward)
+        if size:
+            items = items[:size]
+
+        # Next items
+        if size == 0 or len(items) < size:
+            rest = results.search(query)
+            rest = rest.get_documents(sort_by=sort_by, reverse=not forward,
+                                      size=(size - len(items)) if size else 0)
+            if size and rest:
+                # The last items with the same value are cut by the
+                # batch, take the first ones in the abspath order
+                last_value = getattr(rest[-1], sort_by)
+                if last_value is not None:
+                    nb = len([ x for x in rest
+                               if getattr(x, sort_by) == last_value ])
+                    rest = [ x for x in rest
+                             if getattr(x, sort_by) != last_value ]
+                    last = RangeQuery(sort_by, last_value, last_value)
+                    last = results.search(last).get_documents()
+                    last.sort(key=lambda x: x.abspath, reverse=not forward)
+                    rest.extend(last[:nb])
+            rest.sort(key=lambda x: (get_none_safe_key(getattr(x, sort_by)),
+                                     x.abspath),
+                      reverse=not forward)
+            items.extend(rest)
+
+        if not after:
+            items.reverse()
+        return items
+
+
+    def get_batch_documents(self, resource, context, results):
+        """Return the brains of the batch (not checked against the ACL).
+        """
+        # Computed once for get_batch_namespace and sort_and_batch
+        cache = get_request_cache(context)
+        key = (self.__class__, self._get_query_suffix(), id(results))
+        return cache.get('MultipleFeed_View.get_batch_documents', key,
+                         self._get_batch_documents, resource, context,
+                         results)
+
 
+    def _get_batch_documents(self, resource, context, results):
         start = self._get_query_value(resource, context, 'batch_start')
         size = self._get_query_value(resource, context, 'batch_size')
         sort_by = self._get_query_value(resource, context, 'sort_by')
         reverse = self._get_query_value(resource, context, 'reverse')
+        cursor, after = self._get_cursor(resource, context, results, sort_by)
 
         if sort_by is None:
             get_key = None
         else:
             get_key = getattr(self, 'get_key_sorted_by_' + sort_by, None)
         if get_key:
-            # Custom but slower sort algorithm
-            items = results.get_documents()
-            items.sort(key=get_key(), reverse=reverse)
-            if size:
-                items = items[start:start+size]
-            elif start:
-                items = items[start:]
-        else:
-            # Faster Xapian sort algorithm
-            items = results.get_documents(sort_by=sort_by, reverse=reverse,
-                                          start=start, size=size)
+            return self._get_key_documents(results, get_key, reverse, start,
+                                           size, cursor, after)
+        elif cursor is not None:
+            return self._get_keyset_documents(results, sort_by, reverse, size,
+                                              cursor, after)
+        # Faster Xapian sort algorithm
+        return results.get_documents(sort_by=sort_by, reverse=reverse,
+                                     start=start, size=size)
+
 
-        # Access Control (FIXME this should be done before batch)
+    def sort_and_batch(self, resource, context, results):
+        user = context.user
+        root = context.root
+        items = self.get_batch_documents(resource, context, results)
+
+        if self.brain_only:
+            # The values are taken from the catalog
+            return self.get_allowed_brains(context, items)
+
+        # Access Control
+        # The catalog already filtered the results by view state (see
+        # Feed_View.get_items), only check the specific ACL on the batch
         allowed_items = []
         for item in items:
             resource = root.get_resource(item.abspath)
@@ -146,10 +309,20 @@ class MultipleFeed_View(Feed_View):
         else:
             namespace['msg'] = self.batch_msg2.gettext(n=total)
 
+        # Cursors (see batch_cursor)
+        first = last = None
+        if self.batch_cursor and size:
+            documents = self.get_batch_documents(resource, context, items)
+            if documents:
+                first = documents[0].abspath
+                last = documents[-1].abspath
+
         # See previous button ?
         if current_page != 1:
             previous = max(batch_start - size, 0)
-            uri = self._context_uri_replace(context, batch_start=previous)
+            uri = self._context_uri_replace(context, batch_start=previous,
+                                            batch_after=None,
+                                            batch_before=first)
             namespace['previous'] = uri
         else:
             namespace['previous'] = None
@@ -157,7 +330,9 @@ class MultipleFeed_View(Feed_View):
         # See next button ?
         if current_page < nb_pages:
             uri = self._context_uri_replace(context,
-                                            batch_start=batch_start+size)
+                                            batch_start=batch_start+size,
+                                            batch_after=last,
+                                            batch_before=None)
             namespace['next'] = uri
         else:
             namespace['next'] = None
@@ -184,7 +359,8 @@ class MultipleFeed_View(Feed_View):
             {'number': i,
              'css': 'current' if i == current_page else None,
              'uri': self._context_uri_replace(context,
-                 batch_start=((i-1) * size))}
+                 batch_start=((i-1) * size), batch_after=None,
+                 batch_before=None)}
              for i in pages ]
 
         # Add ellipsis if needed
@@ -225,7 +401,9 @@ class MultipleFeed_View(Feed_View):
             else:
                 # Type: normal
                 base_href = self._context_uri_replace(context, sort_by=name,
-                                                      batch_start=None)
+                                                      batch_start=None,
+                                                      batch_after=None,
+                                                      batch_before=None)
                 if name == sort_by:
                     sort_up_active = reverse is False
                     sort_down_active = reverse is True
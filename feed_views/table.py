@@ -47,7 +47,8 @@ class TableFeed_View(MultipleFeed_View):
 
     def get_item_value(self, resource, context, item, column):
         """It's specific because we have to return a tuple"""
-        item_brain, item_resource = item
+        item_brain = item[0]
+        item_resource = self.get_item_resource(context, item)
         # Default columns
         if column == 'name':
             name = item_brain.name
@@ -15,6 +15,8 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 # Import from itools
+from itools.database.rw import RWDatabase
+from itools.datatypes import String
 from itools.gettext import MSG
 
 # Import from ikaaro
@@ -24,7 +26,8 @@ from ikaaro.file_views import File_ExternalEdit_View
 from ikaaro.folder import Folder
 from ikaaro.folder_views import Folder_BrowseContent
 from ikaaro.menu import Menu_View
-from ikaaro.registry import resources_registry
+from ikaaro.registry import register_field, resources_registry
+from ikaaro.resource_ import DBResource
 from ikaaro.resource_views import DBResource_Edit
 from ikaaro.revisions_views import DBResource_CommitLog, DBResource_Changes
 from ikaaro.root import Root
@@ -37,6 +40,11 @@ from feed_views import Browse_Navigator, Browse_Navigator_Rename
 from itws.control_panel import CPDBResource_Backlinks, CPDBResource_CommitLog
 from itws.control_panel import CPExternalEdit, CPDBResource_Links
 from itws.control_panel import ITWS_ControlPanel
+from itws.sitemap import sitemap_cache
+from itws.tags import tags_counter
+from itws.utils import fragment_caches, get_view_state
+from itws.utils import invalidate_fragment_caches
+from itws.utils import site_resources_cache
 from popup import ITWS_DBResource_AddImage, ITWS_DBResource_AddLink
 from popup import ITWS_DBResource_AddMedia
 from views import Folder_NewResource
@@ -115,3 +123,62 @@ for cls in resources_registry.values():
     cls.add_link = ITWS_DBResource_AddLink()
     cls.add_media = ITWS_DBResource_AddMedia()
 
+
+# Index the view state of every resource
+# Used by Feed_View & BaseRSS to check ACL before the batch
+register_field('view_state', String(indexed=True, stored=True))
+
+DBResource__get_catalog_values = DBResource.get_catalog_values
+def get_catalog_values(self):
+    values = DBResource__get_catalog_values(self)
+    values['view_state'] = get_view_state(self)
+    return values
+DBResource.get_catalog_values = get_catalog_values
+
+
+# Evict the fragment caches and the singleton resources, update the number
+# of items by tag and the sitemaps on commit
+RWDatabase__save_changes = RWDatabase.save_changes
+def save_changes(self, *args, **kw):
+    # Added, changed, moved and removed resources
+    paths = set()
+    # Added, moved and removed resources (not changed)
+    moves = set()
+    for changes in (self.resources_old2new, self.resources_new2old):
+        for source, target in changes.iteritems():
+            paths.update([ x for x in (source, target) if x ])
+            if source != target:
+                moves.add(source)
+    old_formats = site_resources_cache.get_values(self.catalog, moves)
+    # The tags of the changed resources, before and after, for the tags
+    # counter, the sitemaps and the fragment caches (all start again on too
+    # many changes)
+    get_values = False
+    if len(paths) > tags_counter.max_changes:
+        tags_counter.clear()
+    elif (tags_counter.sites or sitemap_cache.sites
+          or [ x for x in fragment_caches if x.values ]):
+        get_values = True
+    old_values = new_values = {}
+    if get_values:
+        old_values = tags_counter.get_values(self.catalog, paths)
+    RWDatabase__save_changes(self, *args, **kw)
+    if get_values:
+        new_values = tags_counter.get_values(self.catalog, paths)
+    tags_counter.update(old_values, new_values)
+    # The views of the tags depend on the tagged resources: evict the tags
+    # of every container (one of them is the website)
+    tags_paths = set()
+    for values in (old_values, new_values):
+        for path, (tags, view_state) in values.iteritems():
+            base = path
+            while base != '/':
+                base = base.rsplit('/', 1)[0] or '/'
+                for tag in tags or []:
+                    tags_paths.add('%s/tags/%s' % (base.rstrip('/'), tag))
+    invalidate_fragment_caches(paths | tags_paths)
+    sitemap_cache.invalidate(paths, (old_values, new_values))
+    if moves:
+        new_formats = site_resources_cache.get_values(self.catalog, moves)
+        site_resources_cache.invalidate(moves, old_formats, new_formats)
+RWDatabase.save_changes = save_changes
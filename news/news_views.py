@@ -102,6 +102,8 @@ class NewsFolder_View(Details_View):
     search_template = None
     sort_by = 'pub_datetime'
     reverse = True
+    brain_only = True
+    fragment_cache = True
 
     # Display sidebar
     display_sidebar = True
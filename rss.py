@@ -17,6 +17,7 @@
 
 # Import from standard library
 from datetime import datetime
+from hashlib import md5
 
 # Import from itools
 from itools.core import freeze
@@ -26,12 +27,31 @@ from itools.gettext import MSG
 from itools.html import stream_to_str_as_xhtml
 from itools.rss import RSSFile
 from itools.stl import set_prefix
-from itools.web import BaseView, get_context
+from itools.web import BaseView, NotModified, get_context
 
 # Import from ikaaro
 from ikaaro.utils import get_base_path_query
 from ikaaro.webpage import WebPage
 
+# Import from itws
+from utils import FragmentCache, get_allowed_to_view_query, get_request_cache
+from utils import get_site_role
+
+
+
+# Serialized feeds and rendered item descriptions
+rss_cache = FragmentCache()
+rss_descriptions_cache = FragmentCache(size=5000)
+
+
+def to_naive_utc(value):
+    """The HTTP dates are naive UTC datetimes, the publication dates are
+    aware (see NeutralWS.update_20101015).
+    """
+    if value is not None and value.tzinfo is not None:
+        value = (value - value.utcoffset()).replace(tzinfo=None)
+    return value
+
 
 
 class BaseRSS(BaseView):
@@ -137,6 +157,11 @@ class BaseRSS(BaseView):
         if query2:
             query.append(query2)
 
+        # Access Control (done by the catalog, before the batch)
+        query2 = get_allowed_to_view_query(context)
+        if query2 is not None:
+            query.append(query2)
+
         query = AndQuery(*query)
         return resource.get_root().search(query)
 
@@ -151,7 +176,9 @@ class BaseRSS(BaseView):
     def sort_and_batch(self, resource, context, results):
         items = self._sort_and_batch(resource, context, results)
 
-        # Access Control (FIXME this should be done before batch)
+        # Access Control
+        # The catalog already filtered the results by view state (see
+        # get_items), only check the specific ACL on the batch
         user = context.user
         root = context.root
         allowed_items = []
@@ -165,17 +192,58 @@ class BaseRSS(BaseView):
         return allowed_items
 
 
+    def get_validators(self, resource, context):
+        """Return the last modification time and the entity tag of the
+        feed, computed from the catalog without loading the items.
+        """
+        cache = get_request_cache(context)
+        key = (self.__class__.__name__, str(resource.get_abspath()))
+        return cache.get('BaseRSS.get_validators', key,
+                         self._get_validators, resource, context)
+
+
+    def _get_validators(self, resource, context):
+        results = self.get_items(resource, context)
+        # The newest publication or modification date
+        mtime = None
+        for name in ('pub_datetime', 'mtime'):
+            for brain in results.get_documents(sort_by=name, reverse=True,
+                                               size=1):
+                value = to_naive_utc(getattr(brain, name))
+                if value is not None and (mtime is None or value > mtime):
+                    mtime = value
+        if mtime is not None:
+            mtime = mtime.replace(microsecond=0)
+        # The feed also depends on the number of items (removed items),
+        # the channel (title, language) and the role of the user (ACL)
+        channel = self.get_channel(resource, context)
+        channel = [ u'%s=%s' % x for x in sorted(channel.items()) ]
+        role = get_site_role(context)
+        etag = '%s %s %s %s %s' % (resource.get_abspath(), len(results),
+                                   mtime and mtime.isoformat(),
+                                   u' '.join(channel).encode('utf-8'), role)
+        etag = '"%s"' % md5(etag).hexdigest()
+        return mtime, etag
+
+
+    def is_not_modified(self, resource, context):
+        mtime, etag = self.get_validators(resource, context)
+        # If-None-Match has precedence over If-Modified-Since
+        if_none_match = context.get_header('if-none-match')
+        if if_none_match:
+            etags = [ x.strip() for x in if_none_match.split(',') ]
+            etags = [ x[2:] if x.startswith('W/') else x for x in etags ]
+            return etag in etags or '*' in etags
+        if_modified_since = context.get_header('if-modified-since')
+        if if_modified_since and mtime is not None:
+            return to_naive_utc(if_modified_since) >= mtime
+        return False
+
+
     def get_mtime(self, resource):
         context = get_context()
-        items = self.get_items(resource, context)
-        items = self.sort_and_batch(resource, context, items)
-        # FIXME If there is no modifications ?
-        if not items:
-            return
-        last_brain = items[0][0]
-        dow = last_brain.pub_datetime
-        # date -> datetime
-        return datetime(dow.year, dow.month, dow.day)
+        mtime, etag = self.get_validators(resource, context)
+        return mtime
 
 
     def get_item_value(self, resource, context, item, column, site_root):
@@ -195,16 +263,18 @@ class BaseRSS(BaseView):
                 if data is None:
                     # Skip empty content
                     return ''
-                # Set the prefix
+                # Set the prefix (from the website, the same for every
+                # page of the website)
                 prefix = site_root.get_pathto(item_resource)
-                data = set_prefix(data, '%s/' % prefix, uri=context.uri)
+                data = set_prefix(data, '%s/' % prefix,
+                                  uri=context.uri.resolve('/'))
                 data = stream_to_str_as_xhtml(data)
                 return data.decode('utf-8')
             else:
                 return item_resource.get_property('description')
 
 
-    def GET(self, resource, context):
+    def get_language(self, resource, context):
         language = context.get_query_value('language')
         if language is None:
             # Get Language
@@ -212,32 +282,84 @@ class BaseRSS(BaseView):
             ws_languages = site_root.get_property('website_languages')
             accept = context.accept_language
             language = accept.select_language(ws_languages)
+        return language
+
+
+    def get_channel(self, resource, context):
+        language = self.get_language(resource, context)
+        site_root = resource.get_site_root()
+        host = context.uri.authority
+        return {
+            'title': site_root.get_property('title'),
+            'link': 'http://%s/?language=%s' % (host, language),
+            'description': MSG(u'Last News').gettext(),
+            'language': language}
+
+
+    def get_item_description(self, resource, context, item, site_root,
+                             language):
+        """The rendered description of an item, cached by item path and
+        mtime: an edit only renders the edited item again.
+        """
+        brain, item_resource = item
+        # The links are resolved against the website (see get_item_value)
+        key = (self.__class__.__name__, brain.abspath, brain.mtime,
+               str(context.uri.resolve('/')), language,
+               get_site_role(context))
+        description = rss_descriptions_cache.get(key)
+        if description is None:
+            description = self.get_item_value(resource, context, item,
+                                              'description', site_root)
+            rss_descriptions_cache.set(key, description, [brain.abspath])
+        return description
+
+
+    def GET(self, resource, context):
+        # Conditional GET, answered before building the feed
+        mtime, etag = self.get_validators(resource, context)
+        context.set_header('ETag', etag)
+        if mtime is not None:
+            context.set_header('Last-Modified', mtime)
+        if self.is_not_modified(resource, context):
+            raise NotModified
+
+        # Filename and Content-Type
+        context.set_content_disposition('inline', "last_news.rss")
+        context.set_content_type('application/rss+xml')
+
+        # The channel
+        language = self.get_language(resource, context)
+        site_root = resource.get_site_root()
+        channel = self.get_channel(resource, context)
+
+        # Cached feed, the entity tag changes with the items
         if_modified_since = context.get_header('if-modified-since')
+        key = (self.__class__.__name__, str(resource.get_abspath()), etag,
+               if_modified_since, tuple(sorted(channel.items())))
+        data = rss_cache.get(key)
+        if data is not None:
+            return data
+
         items = self.get_items(resource, context, if_modified_since)
         items = self.sort_and_batch(resource, context, items)
 
         # Construction of the RSS flux
         feed = RSSFile()
-
-        site_root = resource.get_site_root()
-        host = context.uri.authority
-        # The channel
-        channel = feed.channel
-        channel['title'] = site_root.get_property('title')
-        channel['link'] = 'http://%s/?language=%s' % (host, language)
-        channel['description'] = MSG(u'Last News').gettext()
-        channel['language'] = language
+        feed.channel.update(channel)
 
         # The new items
         feed_items = feed.items
         for item in items:
             ns = {}
-            for key in ('link', 'guid', 'title', 'pubDate', 'description'):
-                ns[key] = self.get_item_value(resource, context, item, key,
-                                              site_root)
+            for key2 in ('link', 'guid', 'title', 'pubDate'):
+                ns[key2] = self.get_item_value(resource, context, item, key2,
+                                               site_root)
+            ns['description'] = self.get_item_description(resource, context,
+                    item, site_root, language)
             feed_items.append(ns)
 
-        # Filename and Content-Type
-        context.set_content_disposition('inline', "last_news.rss")
-        context.set_content_type('application/rss+xml')
-        return feed.to_str()
+        data = feed.to_str()
+        # Added items change the entity tag, changed items are evicted
+        paths = [ brain.abspath for brain, item_resource in items ]
+        rss_cache.set(key, data, paths)
+        return data
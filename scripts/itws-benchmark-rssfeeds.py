@@ -0,0 +1,316 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Benchmark of the RSS aggregator (RssFeeds) against a local feed server.
+
+Usage:
+
+    python scripts/itws-benchmark-rssfeeds.py [options] <ikaaro instance>
+
+A local HTTP server serves synthetic RSS 2.0 and Atom feeds, with a
+configurable number of items, latency, error rate and 304 behaviour.
+A temporary RssFeeds resource is made in the given instance (the changes
+are never saved), RssFeeds.update_rss and RssFeeds_View.get_namespace
+are run several times (the first refresh is cold, the next ones may be
+answered by 304) and the wall time, CPU time and articles per second are
+reported, with the peak memory of the whole process (ru_maxrss).  Do not
+use the instance of a running server.
+
+Note: itools.rss only reads RSS 2.0, the Atom feeds measure the cost of
+the parse errors.
+"""
+
+# Import from the Standard Library
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from datetime import datetime, timedelta
+from hashlib import md5
+from optparse import OptionParser
+from os import remove
+from os.path import exists
+from random import Random
+from resource import getrusage, RUSAGE_SELF
+from threading import Thread
+from time import sleep, time
+
+# Import from itools
+from itools.datatypes import HTTPDate
+from itools.i18n import AcceptLanguageType
+from itools.uri import get_reference
+from itools.web import set_context
+
+# Import from ikaaro
+from ikaaro.server import Server, get_fake_context
+
+# Import from itws
+from itws.OPML.rssfeeds import RssFeeds
+
+
+
+######################################################################
+# Feed server
+######################################################################
+rss_template = """<?xml version="1.0" encoding="UTF-8"?>
+<rss version="2.0">
+  <channel>
+    <title>Feed %(number)s</title>
+    <link>http://localhost/%(number)s</link>
+    <description>Synthetic feed %(number)s</description>
+    %(items)s
+  </channel>
+</rss>"""
+
+rss_item_template = """<item>
+      <title>Item %(number)s of feed %(feed)s</title>
+      <link>http://localhost/%(feed)s/%(number)s</link>
+      <pubDate>%(date)s</pubDate>
+      <description>&lt;p&gt;Item %(number)s, &lt;a href="page%(number)s"&gt;
+      a link&lt;/a&gt; and &lt;img src="image%(number)s.png" /&gt;
+      %(text)s&lt;/p&gt;</description>
+    </item>"""
+
+atom_template = """<?xml version="1.0" encoding="UTF-8"?>
+<feed xmlns="http://www.w3.org/2005/Atom">
+  <title>Feed %(number)s</title>
+  <link href="http://localhost/%(number)s"/>
+  <updated>%(date)s</updated>
+  %(items)s
+</feed>"""
+
+atom_item_template = """<entry>
+    <title>Item %(number)s of feed %(feed)s</title>
+    <link href="http://localhost/%(feed)s/%(number)s"/>
+    <updated>%(date)s</updated>
+    <content type="html">&lt;p&gt;Item %(number)s %(text)s&lt;/p&gt;</content>
+  </entry>"""
+
+lorem = ('Lorem ipsum dolor sit amet, consectetur adipiscing elit, sed do '
+         'eiusmod tempor incididunt ut labore et dolore magna aliqua. ')
+
+
+def make_feed(number, items, atom, text_size):
+    """Return the body of the synthetic feed number "number".
+    """
+    now = datetime(2011, 1, 1)
+    text = (lorem * (text_size / len(lorem) + 1))[:text_size]
+    feed_items = []
+    for item in range(items):
+        date = now - timedelta(hours=item)
+        if atom:
+            template = atom_item_template
+            date = date.strftime('%Y-%m-%dT%H:%M:%SZ')
+        else:
+            template = rss_item_template
+            date = HTTPDate.encode(date)
+        feed_items.append(template % {'number': item, 'feed': number,
+                                      'date': date, 'text': text})
+    template = atom_template if atom else rss_template
+    return template % {'number': number, 'date': now.isoformat(),
+                       'items': '\n'.join(feed_items)}
+
+
+
+class FeedRequestHandler(BaseHTTPRequestHandler):
+    """Serve /<number>.rss and /<number>.atom, see FeedServer.
+    """
+
+    def do_GET(self):
+        server = self.server
+        sleep(server.latency)
+        # Errors
+        if server.random.random() < server.error_rate:
+            self.send_error(500, 'Synthetic error')
+            return
+        # Feed
+        name, extension = self.path.strip('/').split('.')
+        data = server.get_feed(int(name), extension == 'atom')
+        etag = '"%s"' % md5(data).hexdigest()
+        if server.not_modified and self.headers.get('If-None-Match') == etag:
+            server.nb_not_modified += 1
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/xml')
+        self.send_header('Content-Length', str(len(data)))
+        self.send_header('ETag', etag)
+        self.end_headers()
+        self.wfile.write(data)
+
+
+    def log_message(self, format, *args):
+        pass
+
+
+
+class FeedServer(ThreadingMixIn, HTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self, items=20, latency=0.0, error_rate=0.0,
+                 not_modified=True, text_size=500):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), FeedRequestHandler)
+        self.items = items
+        self.latency = latency
+        self.error_rate = error_rate
+        self.not_modified = not_modified
+        self.text_size = text_size
+        self.random = Random(0)
+        self.feeds = {}
+        self.nb_not_modified = 0
+
+
+    def get_feed(self, number, atom):
+        key = (number, atom)
+        if key not in self.feeds:
+            self.feeds[key] = make_feed(number, self.items, atom,
+                                        self.text_size)
+        return self.feeds[key]
+
+
+    def get_uri(self, number, atom=False):
+        host, port = self.server_address
+        extension = 'atom' if atom else 'rss'
+        return 'http://%s:%s/%s.%s' % (host, port, number, extension)
+
+
+    def start(self):
+        thread = Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+
+
+######################################################################
+# Benchmark
+######################################################################
+def measure(function, *args):
+    """Call the given function, return its result with the wall time and
+    the CPU time (in seconds) it took.
+    """
+    usage = getrusage(RUSAGE_SELF)
+    cpu_time = usage.ru_utime + usage.ru_stime
+    wall_time = time()
+    result = function(*args)
+    wall_time = time() - wall_time
+    usage = getrusage(RUSAGE_SELF)
+    cpu_time = usage.ru_utime + usage.ru_stime - cpu_time
+    return result, wall_time, cpu_time
+
+
+def get_context(server):
+    context = get_fake_context()
+    context.server = server
+    context.database = server.database
+    context.root = context.site_root = server.root
+    context.user = None
+    context.uri = get_reference('http://localhost/')
+    context.query = {'feed': 'all'}
+    context.accept_language = AcceptLanguageType.decode('en')
+    set_context(context)
+    return context
+
+
+def benchmark(target, options):
+    # The feed server
+    feed_server = FeedServer(items=options.items, latency=options.latency,
+                             error_rate=options.error_rate,
+                             not_modified=not options.no_304,
+                             text_size=options.text_size)
+    feed_server.start()
+
+    # The aggregator (never saved)
+    server = Server(target)
+    context = get_context(server)
+    resource = server.root.make_resource('rssfeeds-benchmark', RssFeeds)
+    for name in ('timeout', 'deadline'):
+        resource.set_property(name, getattr(options, name))
+    resource.set_property('max_articles', 0)
+    RssFeeds.download_workers = options.workers
+    random = Random(1)
+    for number in range(options.feeds):
+        atom = random.random() < options.atom_rate
+        uri = feed_server.get_uri(number, atom)
+        resource.handler.add_row([uri, u'', True])
+
+    print 'Feeds: %s (%s items), latency: %ss, error rate: %s' % (
+        options.feeds, options.items, options.latency, options.error_rate)
+    print
+    print ('%-8s %10s %10s %10s %12s %10s %8s' %
+           ('Round', 'Refresh', 'CPU', 'View', 'Articles/s', 'Articles',
+            '304'))
+    try:
+        for number in range(options.rounds):
+            nb_not_modified = feed_server.nb_not_modified
+            ignore, wall_time, cpu_time = measure(resource.update_rss)
+            articles = len(resource.handler.last_articles)
+            ignore, view_time, ignore = measure(resource.view.get_namespace,
+                                                resource, context)
+            speed = articles / wall_time if wall_time else 0
+            nb_not_modified = feed_server.nb_not_modified - nb_not_modified
+            print ('%-8s %9.3fs %9.3fs %9.3fs %12.1f %10s %8s' %
+                   (number + 1, wall_time, cpu_time, view_time, speed,
+                    articles, nb_not_modified))
+    finally:
+        # Remove the on-disk cache of the temporary aggregator
+        path = resource.get_cache_path()
+        if exists(path):
+            remove(path)
+        server.database.abort_changes()
+        feed_server.shutdown()
+
+    # Peak memory of the whole process (server, feed server, all the
+    # rounds), kilobytes on Linux
+    print
+    print ('Peak memory of the process (ru_maxrss): %s KB'
+           % getrusage(RUSAGE_SELF).ru_maxrss)
+
+
+
+if __name__ == '__main__':
+    usage = '%prog [options] TARGET'
+    description = ('Benchmark the RSS aggregator against a local feed '
+                   'server, using the given ikaaro instance.')
+    parser = OptionParser(usage, description=description)
+    parser.add_option('--feeds', type='int', default=40,
+                      help='number of feeds (default 40)')
+    parser.add_option('--items', type='int', default=20,
+                      help='number of items by feed (default 20)')
+    parser.add_option('--text-size', type='int', default=500,
+                      help='size of the description of an item (default 500)')
+    parser.add_option('--latency', type='float', default=0.1,
+                      help='latency of the feed server in seconds '
+                           '(default 0.1)')
+    parser.add_option('--error-rate', type='float', default=0.0,
+                      help='rate of the requests answered by a 500 error '
+                           '(default 0)')
+    parser.add_option('--atom-rate', type='float', default=0.0,
+                      help='rate of the Atom feeds (default 0)')
+    parser.add_option('--no-304', action='store_true', default=False,
+                      help='never answer 304 Not Modified')
+    parser.add_option('--rounds', type='int', default=3,
+                      help='number of refreshes (default 3)')
+    workers = RssFeeds.download_workers
+    parser.add_option('--workers', type='int', default=workers,
+                      help='number of download threads (default %s)' % workers)
+    parser.add_option('--timeout', type='float', default=1.0,
+                      help='timeout by request in seconds (default 1)')
+    parser.add_option('--deadline', type='float', default=30.0,
+                      help='deadline of a refresh in seconds (default 30)')
+    options, args = parser.parse_args()
+    if len(args) != 1:
+        parser.error('incorrect number of arguments')
+    benchmark(args[0], options)
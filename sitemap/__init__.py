@@ -23,7 +23,7 @@ from itools.relaxng import RelaxNGFile
 from itools.xml import XMLNamespace, register_namespace
 
 # Import from itws
-from sitemap import SiteMap
+from sitemap import SiteMap, sitemap_cache
 
 
 #############################################################################
@@ -45,4 +45,4 @@ for namespace in rng_file.namespaces.itervalues():
 rng_file.auto_register()
 
 # Silent pyflakes
-SiteMap
+SiteMap, sitemap_cache
@@ -18,25 +18,170 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+# Import from the Standard Library
+from bisect import bisect_right
+from cStringIO import StringIO
+from datetime import datetime
+from gzip import GzipFile
+from itertools import islice
+from threading import Lock
+
 # Import from itools
-from itools.datatypes import Integer
+from itools.datatypes import Integer, XMLContent
 from itools.gettext import MSG
-from itools.stl import stl
-from itools.web import BaseView
+from itools.web import BaseView, NotModified
 from itools.database import AndQuery, OrQuery, PhraseQuery
 
 # Import from ikaaro
 from ikaaro.folder import Folder
 from ikaaro.utils import get_base_path_query
 
+# Import from itws
+from itws.tags import Tag
+from itws.utils import DiskCacheStorage, get_request_cache, is_in_path
+
+
+
+sitemap_namespace = 'http://www.sitemaps.org/schemas/sitemap/0.9'
+
+def write_urlset(file, urls):
+    """Write the sitemap of the given urls, an iterable of (loc, lastmod),
+    to the given file object. The entries are written one by one.
+    """
+    file.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+    file.write('<urlset xmlns="%s">\n' % sitemap_namespace)
+    for loc, lastmod in urls:
+        file.write('<url><loc>%s</loc><lastmod>%s</lastmod></url>\n'
+                   % (XMLContent.encode(loc), lastmod))
+    file.write('</urlset>\n')
+
+
+def write_sitemapindex(file, locs):
+    """Write the sitemap index of the given sitemaps (their urls) to the
+    given file object.
+    """
+    file.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+    file.write('<sitemapindex xmlns="%s">\n' % sitemap_namespace)
+    for loc in locs:
+        file.write('<sitemap><loc>%s</loc></sitemap>\n'
+                   % XMLContent.encode(loc))
+    file.write('</sitemapindex>\n')
+
+
+def gzip_data(data):
+    buffer = StringIO()
+    file = GzipFile(mode='wb', fileobj=buffer)
+    file.write(data)
+    file.close()
+    return buffer.getvalue()
+
+
+
+class SiteMapCache(object):
+    """The sitemaps of every website, written once and kept on disk (plain
+    and compressed) until a resource of the website changes (in memory,
+    by process).
+
+    The pages are sorted by path: a change only updates the page of the
+    changed resource and the next ones (see invalidate, called on
+    commit).
+    """
+
+    # Above this number of changed resources, write the whole sitemap
+    max_changes = 1000
+    storage = DiskCacheStorage('sitemap')
+
+    def __init__(self):
+        # {(site path, base uri): {'pages': [first path of every page],
+        #                          'count': number of urls,
+        #                          'mtime': datetime,
+        #                          'changes': set of paths}}
+        self.sites = {}
+        # {site key: lock held while the sitemap is written}
+        self.site_locks = {}
+        self.lock = Lock()
+
+
+    def get_site_lock(self, site_key):
+        self.lock.acquire()
+        try:
+            lock = self.site_locks.get(site_key)
+            if lock is None:
+                lock = self.site_locks[site_key] = Lock()
+            return lock
+        finally:
+            self.lock.release()
+
+
+    def get_key(self, site_key, name):
+        return '%s %s %s' % (site_key[0], site_key[1], name)
+
+
+    def get_data(self, resource, site_key, name):
+        return self.storage.get(resource, self.get_key(site_key, name))
+
+
+    def set_data(self, resource, site_key, name, data):
+        self.storage.set(resource, self.get_key(site_key, name), data)
+
+
+    def get_first_page(self, site):
+        """Return the index of the first page to write again, None if the
+        sitemap is up to date.
+        """
+        changes = site['changes']
+        if not changes:
+            return None
+        pages = site['pages']
+        return max(min([ bisect_right(pages, x) for x in changes ]) - 1, 0)
+
+
+    def invalidate(self, paths, tags_values):
+        """Remember the changed paths of the websites: the paths of the
+        changed resources, of their container (newest child) and of their
+        old and new tags (newest tagged resource). "tags_values" are the
+        values of TagsCounter.get_values before and after the commit.
+        """
+        self.lock.acquire()
+        try:
+            for site_key, site in self.sites.items():
+                site_path = site_key[0]
+                changes = [ x for x in paths if is_in_path(x, site_path) ]
+                if len(changes) > self.max_changes:
+                    # Write the whole sitemap
+                    site['changes'].add(site_path)
+                    continue
+                for path in changes:
+                    site['changes'].add(path)
+                    site['changes'].add(path.rsplit('/', 1)[0])
+                for values in tags_values:
+                    for path, (tags, view_state) in values.iteritems():
+                        if is_in_path(path, site_path):
+                            for tag in tags or []:
+                                site['changes'].add('%s/tags/%s'
+                                                    % (site_path, tag))
+        finally:
+            self.lock.release()
+
+
+    def clear(self):
+        self.sites.clear()
+
+
+sitemap_cache = SiteMapCache()
+
 
 
 class SiteMapView(BaseView):
 
-    template = '/ui/common/sitemap.xml'
     access = True
     query_schema = {'id': Integer}
 
+    # Max urls according to sitemaps.org
+    max_urls = 50000
+    # Send sitemap.xml.gz
+    compress = False
+
 
     def get_items_query(self, resource, context):
         site_root = resource.parent
@@ -71,52 +216,198 @@ class SiteMapView(BaseView):
             path_to_brain_resource = r_abspath.get_pathto(path_reference)
             return context.uri.resolve('/%s' % path_to_brain_resource)
         elif column == 'lastmod':
-            # TODO Find a solution for aggregators of views/contents
-            # (Aggregators of news/tags/webpages)
-            return brain.mtime.strftime('%Y-%m-%d')
+            cache = get_request_cache(context)
+            key = (self.__class__.__name__, str(resource.get_abspath()))
+            lastmods = cache.get('SiteMapView.get_lastmods', key,
+                                 self._get_lastmods, resource, context)
+            return self.get_lastmod(brain, lastmods)
+
+
+    def _get_lastmods(self, resource, context):
+        query = self.get_items_query(resource, context)
+        results = context.root.search(query)
+        return self.get_lastmods(resource, context, results, 0)
+
+
+    def get_lastmods(self, resource, context, results, start):
+        """Return the last modification time of the aggregators (folders
+        and tags) of the sitemap, from the item given by "start": the
+        newest of their children, or of their tagged items for the tags.
+        """
+        lastmods = {}
+        tags = []
+        for brain in results.get_documents(sort_by='abspath', start=start):
+            parent_path = brain.abspath.rsplit('/', 1)[0]
+            mtime = lastmods.get(parent_path)
+            if mtime is None or brain.mtime > mtime:
+                lastmods[parent_path] = brain.mtime
+            if brain.format == Tag.class_id:
+                tags.append(brain)
+
+        # The tagged items may be anywhere in the website
+        items_query = self.get_items_query(resource, context)
+        for brain in tags:
+            query = AndQuery(items_query, PhraseQuery('tags', brain.name))
+            results = context.root.search(query)
+            for item in results.get_documents(sort_by='mtime', reverse=True,
+                                              size=1):
+                lastmods[brain.abspath] = item.mtime
+        return lastmods
+
+
+    def get_lastmod(self, brain, lastmods):
+        mtime = lastmods.get(brain.abspath)
+        if mtime is None or brain.mtime > mtime:
+            mtime = brain.mtime
+        return mtime.strftime('%Y-%m-%d')
+
 
+    def get_urls(self, resource, context, results, start):
+        """Yield the path and the (loc, lastmod) of the items from the given
+        one.
+        """
+        lastmods = self.get_lastmods(resource, context, results, start)
+        base_uri = str(context.uri.resolve('/'))
+        for brain in results.get_documents(sort_by='abspath', start=start):
+            uri = '/'.join(brain.abspath.split('/')[2:])
+            yield brain.abspath, (base_uri + uri,
+                                  self.get_lastmod(brain, lastmods))
 
-    def get_namespace(self, resource, context):
-        # Max urls according to sitemaps.org is 50000
-        # Set to 5000 for performances
-        max_urls = 5000
-        urls = []
-        sitemaps = []
 
+    def get_sitemap_uri(self, resource, context):
+        uri = context.uri.resolve(context.get_link(resource))
+        return str(uri)
+
+
+    def get_sitemap(self, resource, context):
+        """Return the key and the state of the sitemap of the website, the
+        changed pages are written again.
+        """
+        site_path = str(resource.parent.get_canonical_path())
+        site_key = (site_path, str(context.uri.resolve('/')))
+        cache = sitemap_cache
+        # Only the requests on the same sitemap wait for its update
+        site_lock = cache.get_site_lock(site_key)
+        site_lock.acquire()
+        try:
+            cache.lock.acquire()
+            try:
+                site = cache.sites.get(site_key)
+                if site is None:
+                    site = {'pages': [], 'count': 0, 'mtime': None,
+                            'changes': set()}
+                    first_page = 0
+                else:
+                    first_page = cache.get_first_page(site)
+                changes = site['changes']
+                if first_page is not None:
+                    site['changes'] = set()
+            finally:
+                cache.lock.release()
+            if first_page is not None:
+                try:
+                    self.update_sitemap(resource, context, site_key, site,
+                                        first_page)
+                except Exception:
+                    cache.lock.acquire()
+                    try:
+                        site['changes'].update(changes)
+                    finally:
+                        cache.lock.release()
+                    raise
+                cache.lock.acquire()
+                try:
+                    cache.sites[site_key] = site
+                finally:
+                    cache.lock.release()
+        finally:
+            site_lock.release()
+        return site_key, site
+
+
+    def update_sitemap(self, resource, context, site_key, site, first_page):
+        """Write the pages of the sitemap from the given one, and the
+        index.
+        """
         query = self.get_items_query(resource, context)
-        items = context.root.search(query)
+        results = context.root.search(query)
+        max_urls = self.max_urls
+        pages = site['pages'][:first_page]
 
-        nb_items = len(items)
-        id_sitemap = context.query['id']
-        if nb_items <= max_urls or id_sitemap:
-            # id_sitemap is None if id is not specified in the query
-            start = 0 if id_sitemap is None else (id_sitemap - 1) * max_urls
-            base_uri = str(context.uri.resolve('/'))
-            for brain in items.get_documents(sort_by='abspath',
-                                             start=start, size=max_urls):
-                uri = '/'.join(brain.abspath.split('/')[2:])
-                urls.append(
-                    {'loc': base_uri + uri,
-                     'lastmod': brain.mtime.strftime('%Y-%m-%d')})
-        else:
-            nb_sitemaps = nb_items / max_urls
-            if nb_items % max_urls > 0:
-                nb_sitemaps += 1
-            for i in range(1, nb_sitemaps+1):
-                loc = context.uri.replace(id=i)
-                sitemaps.append(str(loc))
+        urls = self.get_urls(resource, context, results,
+                             first_page * max_urls)
+        page = first_page
+        while True:
+            data = StringIO()
+            page_urls = list(islice(urls, max_urls))
+            if not page_urls:
+                break
+            pages.append(page_urls[0][0])
+            write_urlset(data, [ x[1] for x in page_urls ])
+            data = data.getvalue()
+            name = '%s.xml' % (page + 1)
+            sitemap_cache.set_data(resource, site_key, name, data)
+            sitemap_cache.set_data(resource, site_key, '%s.gz' % name,
+                                   gzip_data(data))
+            page += 1
+
+        # The index
+        uri = self.get_sitemap_uri(resource, context)
+        for name, base in (('index.xml', uri),
+                           ('index.xml.gz', '%s/;gz' % uri)):
+            data = StringIO()
+            sitemaps = [ '%s?id=%s' % (base, x + 1)
+                         for x in range(len(pages)) ]
+            write_sitemapindex(data, sitemaps)
+            data = data.getvalue()
+            if name.endswith('.gz'):
+                data = gzip_data(data)
+            sitemap_cache.set_data(resource, site_key, name, data)
 
-        return {'urls': urls, 'sitemaps': sitemaps}
+        site['pages'] = pages
+        site['count'] = len(results)
+        # Naive UTC, as the HTTP dates
+        site['mtime'] = datetime.utcnow().replace(microsecond=0)
 
 
     def GET(self, resource, context):
-        # Get the namespace
-        namespace = self.get_namespace(resource, context)
-        # Return xml
-        context.set_content_type('text/xml')
-        # Ok
-        template = resource.get_resource(self.template)
-        return stl(template, namespace, mode='xml')
+        site_key, site = self.get_sitemap(resource, context)
+
+        # Conditional GET
+        mtime = site['mtime']
+        context.set_header('Last-Modified', mtime)
+        if_modified_since = context.get_header('if-modified-since')
+        if if_modified_since and if_modified_since >= mtime:
+            raise NotModified
+
+        id_sitemap = context.query['id']
+        if site['count'] > self.max_urls and id_sitemap is None:
+            name = 'index.xml'
+        elif (id_sitemap or 1) <= len(site['pages']):
+            name = '%s.xml' % (id_sitemap or 1)
+        else:
+            # Out of range (or no url), an empty sitemap
+            name = None
+        if self.compress:
+            context.set_content_type('application/x-gzip')
+        else:
+            context.set_content_type('text/xml')
+
+        if name is None:
+            data = StringIO()
+            write_urlset(data, [])
+            data = data.getvalue()
+            return gzip_data(data) if self.compress else data
+
+        if self.compress:
+            name = '%s.gz' % name
+        data = sitemap_cache.get_data(resource, site_key, name)
+        if data is None:
+            # The file has been removed, write the sitemap again
+            sitemap_cache.invalidate([site_key[0]], ())
+            site_key, site = self.get_sitemap(resource, context)
+            data = sitemap_cache.get_data(resource, site_key, name)
+        return data
 
 
 
@@ -130,6 +421,7 @@ class SiteMap(Folder):
     is_content = False
 
     view = SiteMapView()
+    gz = SiteMapView(compress=True)
 
 
     def get_document_types(self):
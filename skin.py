@@ -38,7 +38,62 @@ from ikaaro.website import WebSite
 from bar import SideBarAware, SideBar_View
 from news import NewsItem
 from skin_views import AdminBarTemplate, LocationTemplate, LanguagesTemplate
-from utils import get_admin_bar, is_navigation_mode
+from utils import FragmentCache, get_admin_bar, get_site_role, is_in_path
+from utils import is_navigation_mode
+
+
+
+# The namespaces of the menu, the footer and the banner, by website,
+# language and role (see Skin.get_cached_namespace)
+skin_namespaces_cache = FragmentCache(size=500)
+
+
+def get_menu_paths(items, site_path):
+    """Return the paths of the resources of the given menu items (their
+    access control hides or shows them), except the website: any change
+    would evict the menu, the menu tables are enough.
+    """
+    paths = []
+    for item in items:
+        real_path = item['real_path']
+        if real_path is not None and str(real_path) != site_path:
+            paths.append(str(real_path))
+        paths.extend(get_menu_paths(item['items'], site_path))
+    return paths
+
+
+def mark_menu_items(items, context):
+    """Return a copy of the given menu items (see get_menu_namespace) with
+    the 'active', 'in_path' and 'class' values of the current page.
+    """
+    here = context.resource
+    here_path = str(here.get_abspath())
+    here_view = context.view_name or here.get_default_view_name()
+    site_path = str(context.site_root.get_abspath())
+
+    marked_items = []
+    for item in items:
+        item = dict(item)
+        active = in_path = False
+        real_path = item['real_path']
+        if real_path is not None:
+            real_path = str(real_path)
+            view = None
+            path = item['path'] or ''
+            if ';' in path:
+                view = path.rsplit(';', 1)[1].split('?')[0]
+            if real_path == here_path:
+                active = (view or here.get_default_view_name()) == here_view
+            # Do not set the website always 'in_path'
+            elif real_path != site_path and is_in_path(here_path, real_path):
+                in_path = True
+        item['active'] = active
+        item['in_path'] = in_path
+        item['class'] = ((active and 'active') or (in_path and 'in_path')
+                         or None)
+        item['items'] = mark_menu_items(item['items'], context)
+        marked_items.append(item)
+    return marked_items
 
 
 ############################################################
@@ -164,12 +219,46 @@ class Skin(BaseSkin):
         return sidebar_resource
 
 
-    def build_nav_namespace(self, context):
+    def get_cached_namespace(self, context, name, function):
+        """Return the namespace built by "function", the same for every page
+        of the website, by language and role. "function" returns the
+        namespace and the paths of the resources it depends on.
+        """
+        site_root = context.site_root
+        ws_languages = site_root.get_property('website_languages')
+        language = context.accept_language.select_language(ws_languages)
+        key = (self.__class__.__name__, name, str(site_root.get_abspath()),
+               language, get_site_role(context))
+        namespace = skin_namespaces_cache.get(key)
+        if namespace is None:
+            namespace, paths = function(context)
+            skin_namespaces_cache.set(key, namespace, paths)
+        return namespace
+
+
+    def _build_nav_namespace(self, context):
         data = self.nav_data
         menu = context.site_root.get_resource(data['src'])
         ns = get_menu_namespace(context,
             data['depth'], data['show_first_child'],
             flat=data['flat'], menu=menu)
+        site_path = str(context.site_root.get_abspath())
+        paths = [menu.get_abspath()] + get_menu_paths(ns['items'], site_path)
+        return ns, paths
+
+
+    def build_nav_namespace(self, context):
+        data = self.nav_data
+        menu = context.site_root.get_resource(data['src'])
+        if data['flat']:
+            # Only the items in path are expanded, not cached
+            ns = get_menu_namespace(context,
+                data['depth'], data['show_first_child'],
+                flat=data['flat'], menu=menu)
+        else:
+            ns = self.get_cached_namespace(context, 'nav',
+                                           self._build_nav_namespace)
+            ns = merge_dicts(ns, items=mark_menu_items(ns['items'], context))
         if is_navigation_mode(context) is True:
             return ns
         # Add [+] item in menu (To edit)
@@ -189,19 +278,20 @@ class Skin(BaseSkin):
         return ns
 
 
-    def build_footer_namespace(self, context):
+    def _build_footer_namespace(self, context):
         data = self.footer_data
         ns = get_menu_namespace(context,
             data['depth'], data['show_first_child'],
             flat=data['flat'], src=data['src'])
 
-        here = context.resource
+        site_root = context.site_root
         # Manipulate directly the table handler
-        footer = context.site_root.get_resource('%s/menu' % data['src'])
+        footer = site_root.get_resource('%s/menu' % data['src'])
         handler = footer.handler
         records = list(handler.get_records_in_order())
         get_value = handler.get_record_value
-        prefix = here.get_pathto(footer)
+        # The same links from every page
+        prefix = '/%s' % site_root.get_pathto(footer)
         # HOOK the namespace
         for index, item in enumerate(ns.get('items', [])):
             record = records[index]
@@ -211,36 +301,64 @@ class Skin(BaseSkin):
             item['html'] = None
             if not path and not title and html_content:
                 html = set_prefix(html_content, '%s/' % prefix)
-                item['html'] = html
+                item['html'] = list(html)
         ns['separator'] = data.get('separator', '|')
+        site_path = str(site_root.get_abspath())
+        paths = get_menu_paths(ns['items'], site_path)
+        paths.append(footer.parent.get_abspath())
+        return ns, paths
+
+
+    def build_footer_namespace(self, context):
+        data = self.footer_data
+        if data['flat']:
+            ns = self._build_footer_namespace(context)[0]
+        else:
+            ns = self.get_cached_namespace(context, 'footer',
+                                           self._build_footer_namespace)
+            ns = merge_dicts(ns, items=mark_menu_items(ns['items'], context))
 
         # admin bar
+        footer = context.site_root.get_resource('%s/menu' % data['src'])
         ns['admin_bar'] = get_admin_bar(footer.parent) # menu folder
 
         return ns
 
 
-    def build_namespace(self, context):
-        namespace = BaseSkin.build_namespace(self, context)
-
-        here = context.resource
-        here_ac = here.get_access_control()
-        site_root = context.site_root
-        theme = site_root.get_resource('theme')
-        # banner namespace
+    def _build_banner_namespace(self, context):
+        theme = context.site_root.get_resource('theme')
+        paths = [theme.get_abspath()]
         banner_ns = {}
         banner_ns['title'] = theme.get_property('banner_title')
-        banner_ns['description'] = site_root.get_property('description')
         banner_path = None
         path = theme.get_property('banner_path')
         if path:
             banner = theme.get_resource(path, soft=True)
             if banner:
+                paths.append(banner.get_abspath())
                 ac = banner.get_access_control()
                 if ac.is_allowed_to_view(context.user, banner):
                     banner_path = context.get_link(banner)
         banner_ns['path'] = banner_path
-        namespace['banner'] = banner_ns
+        # Custom data inside the template
+        custom_data = theme.get_property('custom_data') or ''
+        banner_ns['custom_data'] = list(XMLParser(custom_data))
+        return banner_ns, paths
+
+
+    def build_namespace(self, context):
+        namespace = BaseSkin.build_namespace(self, context)
+
+        here = context.resource
+        here_ac = here.get_access_control()
+        site_root = context.site_root
+        # banner namespace
+        banner_ns = self.get_cached_namespace(context, 'banner',
+                                              self._build_banner_namespace)
+        namespace['banner'] = {
+            'title': banner_ns['title'],
+            'description': site_root.get_property('description'),
+            'path': banner_ns['path']}
 
         # Site search
         text = context.get_form_value('text', type=Unicode)
@@ -267,15 +385,13 @@ class Skin(BaseSkin):
             namespace['resource_class'] = None
 
         # Add custom data inside the template
-        custom_data = theme.get_property('custom_data') or ''
-        namespace['custom_data'] = XMLParser(custom_data)
+        namespace['custom_data'] = banner_ns['custom_data']
 
         # RSS Feeds title
         namespace['rss_feeds'] = self.get_rss_feeds(context)
 
         # Turning footer
-        turning_footer = site_root.get_resource('theme/turning-footer',
-                                                soft=True)
+        turning_footer = site_root.get_turning_footer()
         if turning_footer:
             view = turning_footer.view
             namespace['turning_footer'] = view.GET(turning_footer, context)
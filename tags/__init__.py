@@ -19,7 +19,9 @@ from datatypes import TagsAwareClassEnumerate, TagsList
 from tags import TagsFolder, Tag, TagsAware
 from tags_views import Tag_View
 from utils import register_tags_aware, get_registered_tags_aware_classes
+from utils import get_tags_namespace, tags_counter
 
 # Silent pyflakaes
 TagsAwareClassEnumerate, TagsFolder, Tag, TagsAware, TagsList, Tag_View
-register_tags_aware, get_registered_tags_aware_classes
+register_tags_aware, get_registered_tags_aware_classes, get_tags_namespace
+tags_counter
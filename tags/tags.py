@@ -20,7 +20,7 @@
 # Import from itools
 from itools.datatypes import Boolean, DateTime, String, Unicode, URI
 from itools.gettext import MSG
-from itools.uri import Path, encode_query, get_reference
+from itools.uri import Path, get_reference
 from itools.web import get_context
 from itools.database import AndQuery, PhraseQuery, OrQuery
 
@@ -40,6 +40,8 @@ from ikaaro.views_new import NewInstance
 from datatypes import TagsList
 from tags_views import Tag_View, Tag_Edit, Tag_RSS, TagsFolder_TagCloud
 from tags_views import TagsFolder_BrowseContent
+from utils import get_tags_namespace, tags_counter
+from itws.utils import get_allowed_to_view_query
 from itws.widgets import DualSelectWidget, JSDatetimeWidget
 
 
@@ -150,26 +152,53 @@ class TagsFolder(Folder):
 
 
     def is_empty(self, context):
-        all_tags_aware_query = self.get_tags_query_terms(state='public')
-        all_tags_aware_query = AndQuery(*all_tags_aware_query)
-
         # tags
         tag_brains = self.get_tag_brains(context)
-
-        # all tags
-        all_tags_aware_results = context.root.search(all_tags_aware_query)
-        query = [  PhraseQuery('tags', brain.name)
-                   for brain in tag_brains ]
-        results = all_tags_aware_results.search(OrQuery(*query))
-
-        return len(results) == 0
+        # all tags aware
+        facets = self.get_tags_facets(context, state='public')
+        for brain in tag_brains:
+            if facets.get(brain.name):
+                return False
+        return True
+
+
+    def get_tags_facets(self, context, state=None, formats=[], query=None):
+        """Return {tag name: number of tagged resources} computed in one
+        pass over the stored 'tags' field of the TagsAware resources.
+        The given query is added to the search (i.e. access control).
+        """
+        tags_query = self.get_tags_query_terms(state=state, formats=formats)
+        if query is not None:
+            tags_query.append(query)
+        results = context.root.search(AndQuery(*tags_query))
+
+        facets = {}
+        for brain in results.get_documents():
+            for tag in brain.tags or []:
+                facets[tag] = facets.get(tag, 0) + 1
+        return facets
+
+
+    def get_items_nb(self, tag_name, states=None):
+        """Return the number of TagsAware resources tagged with the given
+        tag, for the given view states (all by default).
+        The counts are maintained on commit (see TagsCounter).
+        """
+        return tags_counter.get_items_nb(self.get_site_root(), tag_name,
+                                         states)
 
 
-    def get_tag_brains(self, context, sort_by='name', size=0, states=['public']):
+    def get_tag_brains(self, context, sort_by='name', size=0, states=['public'],
+                       check_acl=False):
         # tags
         abspath = self.get_canonical_path()
         tags_query = [ get_base_path_query(abspath, depth=1),
                        PhraseQuery('format', Tag.class_id) ]
+        # Only the tags the user is allowed to view
+        if check_acl:
+            acl_query = get_allowed_to_view_query(context)
+            if acl_query is not None:
+                tags_query.append(acl_query)
         # If state is not defined, don't filter on workflow state
         if states:
             workflow_query = [ PhraseQuery('workflow_state', state)
@@ -202,6 +231,8 @@ class TagsAware(object):
             # Catalog
             'is_tagsaware': Boolean(indexed=True, stored=True),
             'preview_content': Unicode(stored=True, indexed=True),
+            'preview_title': Unicode(stored=True, multilingual=True),
+            'preview_thumbnail': String(stored=True, multilingual=True),
             }
 
 
@@ -210,6 +241,18 @@ class TagsAware(object):
         indexes['pub_datetime'] = self.get_property('pub_datetime')
         indexes['is_tagsaware'] = True
         indexes['preview_content'] = self.get_preview_content()
+        # Used by Feed_View.brain_only
+        site_root = self.get_site_root()
+        languages = site_root.get_property('website_languages')
+        preview_title = {}
+        preview_thumbnail = {}
+        for language in languages:
+            preview_title[language] = self.get_long_title(language)
+            thumbnail = self.get_preview_thumbnail(language)
+            if thumbnail is not None:
+                preview_thumbnail[language] = str(thumbnail.get_abspath())
+        indexes['preview_title'] = preview_title
+        indexes['preview_thumbnail'] = preview_thumbnail
         return indexes
 
     ##########################################################################
@@ -217,22 +260,9 @@ class TagsAware(object):
     ##########################################################################
 
     def get_tags_namespace(self, context):
-        tags_folder = self.get_site_root().get_resource('tags')
-        ac = tags_folder.get_access_control()
-        # query
-        query = encode_query(context.uri.query)
-
-        tags = []
-        for tag_name in self.get_property('tags'):
-            tag = tags_folder.get_resource(tag_name)
-            # Check ACL
-            if ac.is_allowed_to_view(context.user, tag) is False:
-                continue
-            href = context.get_link(tag)
-            if query:
-                href = '%s?%s' % (href, query)
-            tags.append({'title': tag.get_title(), 'href': href})
-        return tags
+        site_root = self.get_site_root()
+        return get_tags_namespace(site_root, self.get_property('tags'),
+                                  context)
 
 
     def get_pub_datetime(self):
@@ -300,8 +330,8 @@ class TagsAware(object):
         return result
 
 
-    def get_preview_thumbnail(self):
-        path = self.get_property('thumbnail')
+    def get_preview_thumbnail(self, language=None):
+        path = self.get_property('thumbnail', language=language)
         if not path:
             return None
         ref = get_reference(path)
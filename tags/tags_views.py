@@ -29,7 +29,7 @@ from itools.html import stream_to_str_as_xhtml
 from itools.stl import set_prefix
 from itools.uri import encode_query
 from itools.web import get_context, STLView
-from itools.database import AndQuery, PhraseQuery
+from itools.database import AndQuery
 
 # Import from ikaaro
 from ikaaro.file_views import File_Edit
@@ -41,6 +41,7 @@ from ikaaro.workflow import state_widget
 # Import from itws
 from itws.feed_views import Details_View
 from itws.rss import BaseRSS
+from itws.utils import get_allowed_to_view_query
 from itws.utils import is_navigation_mode
 
 
@@ -97,6 +98,8 @@ class Tag_View(Details_View):
     reverse = True
     search_on_current_folder = False
     search_on_current_folder_recursive = True
+    brain_only = True
+    fragment_cache = True
     # Display sidebar
     display_sidebar = True
 
@@ -147,30 +150,25 @@ class TagsFolder_TagCloud(STLView):
                     type(context.resource) is type(tags_folder):
                 bo_description = True
 
-        tag_brains = tags_folder.get_tag_brains(context, states=[])
+        # Only the tags the user is allowed to view
+        tag_brains = tags_folder.get_tag_brains(context, states=[],
+                                                check_acl=True)
         tag_base_link = '%s/%%s' % context.get_link(tags_folder)
         if self.formats:
             query = {'format': self.formats}
             tag_base_link = '%s?%s' % (tag_base_link, encode_query(query))
 
-        # query
-        root = context.root
-        tags_query = tags_folder.get_tags_query_terms(formats=self.formats)
-        tags_results = root.search(AndQuery(*tags_query))
+        # Number of items by tag (one search)
+        acl_query = get_allowed_to_view_query(context)
+        facets = tags_folder.get_tags_facets(context, formats=self.formats,
+                                             query=acl_query)
 
         items_nb = []
         tags = []
-        ac = tags_folder.get_access_control()
         for brain in tag_brains:
-            # Check ACL
-            # FIXME To improve, use catalog instead resource
-            tag = tags_folder.get_resource(brain.name)
-            if ac.is_allowed_to_view(context.user, tag) is False:
-                continue
             if self.tags_to_show and len(items_nb) == self.tags_to_show:
                 break
-            sub_results = tags_results.search(PhraseQuery('tags', brain.name))
-            nb_items = len(sub_results)
+            nb_items = facets.get(brain.name, 0)
             if nb_items:
                 d = {}
                 title = brain.title or brain.name
@@ -233,28 +231,17 @@ class TagsFolder_BrowseContent(Folder_BrowseContent):
         ('workflow_state', MSG(u'State'))]
 
 
-    def _get_nb_resource_with_tag(self, resource, context, tag_name):
-        # Build the search query
-        query = resource.get_tags_query_terms()
-        query.append(PhraseQuery('tags', tag_name))
-        query = AndQuery(*query)
-
-        # Search
-        return len(context.root.search(query))
-
-
     def get_key_sorted_by_items_nb(self):
+        tags_folder = get_context().resource
         def key(item):
-            context = get_context()
-            return self._get_nb_resource_with_tag(context.resource, context,
-                                                  item.name)
+            return tags_folder.get_items_nb(item.name)
         return key
 
 
     def get_item_value(self, resource, context, item, column):
         brain, item_resource = item
         if column == 'items_nb':
-            nb = self._get_nb_resource_with_tag(resource, context, brain.name)
+            nb = resource.get_items_nb(brain.name)
             return nb, './%s' % brain.name
         elif column == 'name':
             return brain.name
@@ -15,9 +15,16 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+# Import from itools
+from itools.database import AndQuery, OrQuery, PhraseQuery
+from itools.uri import encode_query
+
 # Import from ikaaro
 from ikaaro.registry import get_resource_class
 
+# Import from itws
+from itws.utils import get_request_cache, is_in_path
+
 
 
 ##########################################################################
@@ -35,3 +42,121 @@ def register_tags_aware(resource_class):
 def get_registered_tags_aware_classes():
     return [ get_resource_class(class_id)
              for class_id in tags_aware_registry ]
+
+
+##########################################################################
+# Namespace
+##########################################################################
+def get_tags_namespace(site_root, tags, context):
+    """Return the namespace of the given tag names, the tags the user is
+    not allowed to view are skipped. Used by TagsAware.get_tags_namespace
+    and by Feed_View when the resource is not loaded (brain_only).
+    """
+    tags_folder = site_root.get_tags_folder()
+    tags_folder_path = str(tags_folder.get_abspath())
+    # The same tags are shared by the items of a page
+    cache = get_request_cache(context)
+
+    namespace = []
+    for tag_name in tags:
+        tag = cache.get('get_tags_namespace', (tags_folder_path, tag_name),
+                        _get_tag_namespace, tags_folder, tag_name, context)
+        if tag is not None:
+            namespace.append(tag)
+    return namespace
+
+
+def _get_tag_namespace(tags_folder, tag_name, context):
+    tag = tags_folder.get_resource(tag_name)
+    # Check ACL
+    ac = tags_folder.get_access_control()
+    if ac.is_allowed_to_view(context.user, tag) is False:
+        return None
+    href = context.get_link(tag)
+    # query
+    query = encode_query(context.uri.query)
+    if query:
+        href = '%s?%s' % (href, query)
+    return {'title': tag.get_title(), 'href': href}
+
+
+
+##########################################################################
+# Number of items by tag
+##########################################################################
+class TagsCounter(object):
+    """Number of TagsAware resources by tag and by view state, for every
+    website (in memory, by process).
+
+    The counts of a website are computed with one search the first time
+    they are asked, then they are updated on commit from the catalog
+    values of the changed resources (see monkey_patch).
+    """
+
+    # Above this number of changed resources, recompute the counts
+    max_changes = 1000
+
+    def __init__(self):
+        # {site_root path: {tag name: {view state: number}}}
+        self.sites = {}
+
+
+    def get_counts(self, site_root):
+        site_path = str(site_root.get_canonical_path())
+        counts = self.sites.get(site_path)
+        if counts is None:
+            query = AndQuery(PhraseQuery('parent_paths', site_path),
+                             PhraseQuery('is_tagsaware', True))
+            results = site_root.get_root().search(query)
+            counts = {}
+            for brain in results.get_documents():
+                self._update(counts, brain.tags, brain.view_state, 1)
+            self.sites[site_path] = counts
+        return counts
+
+
+    def get_items_nb(self, site_root, tag_name, states=None):
+        counts = self.get_counts(site_root).get(tag_name, {})
+        if states is None:
+            return sum(counts.itervalues())
+        return sum([ counts.get(state, 0) for state in states ])
+
+
+    def _update(self, counts, tags, view_state, delta):
+        for tag in tags or []:
+            tag_counts = counts.setdefault(tag, {})
+            nb = tag_counts.get(view_state, 0) + delta
+            if nb > 0:
+                tag_counts[view_state] = nb
+            else:
+                tag_counts.pop(view_state, None)
+
+
+    def get_values(self, catalog, paths):
+        """Return the catalog values {path: (tags, view_state)} of the
+        TagsAware resources of the given paths.
+        """
+        if not paths:
+            return {}
+        query = OrQuery(*[ PhraseQuery('abspath', x) for x in paths ])
+        query = AndQuery(PhraseQuery('is_tagsaware', True), query)
+        return dict([ (x.abspath, (x.tags, x.view_state))
+                      for x in catalog.search(query).get_documents() ])
+
+
+    def update(self, old_values, new_values):
+        """Apply the difference between the catalog values before and after
+        a commit, as returned by "get_values".
+        """
+        for site_path, counts in self.sites.iteritems():
+            for values, delta in ((old_values, -1), (new_values, 1)):
+                for path, (tags, view_state) in values.iteritems():
+                    if is_in_path(path, site_path):
+                        self._update(counts, tags, view_state, delta)
+
+
+    def clear(self):
+        self.sites.clear()
+
+
+tags_counter = TagsCounter()
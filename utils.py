@@ -18,13 +18,25 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 # Import from the Standard Library
+from bisect import bisect_left, insort
+from cPickle import dumps, loads, HIGHEST_PROTOCOL
+from collections import OrderedDict
+from copy import copy
 from datetime import datetime, timedelta
+from hashlib import md5
+from os import makedirs, rename, stat
+from os.path import dirname, exists, join
+from threading import Event, Lock, Thread
+from traceback import format_exc
+from types import GeneratorType
 
 # Import from itools
 from itools.core import freeze, thingy
+from itools.database import OrQuery, PhraseQuery
 from itools.datatypes import Boolean, Enumerate, String, XMLContent
 from itools.datatypes import Date, DateTime, PathDataType
 from itools.gettext import MSG
+from itools.log import log_warning
 from itools.stl import stl
 from itools.web import get_context, INFO, FormError
 from itools.xml import XMLParser
@@ -93,6 +105,15 @@ def get_admin_bar(resource, buttons=[]):
     context = get_context()
     if is_navigation_mode(context):
         return
+    if buttons:
+        return _get_admin_bar(resource, buttons, context)
+    # The same box can be displayed several times in a page
+    cache = get_request_cache(context)
+    return cache.get('get_admin_bar', str(resource.get_abspath()),
+                     _get_admin_bar, resource, buttons, context)
+
+
+def _get_admin_bar(resource, buttons, context):
     ac = resource.get_access_control()
     if not ac.is_allowed_to_edit(context.user, resource):
         return
@@ -321,43 +342,668 @@ def is_navigation_mode(context):
     return context.get_cookie('itws_fo_edit', Boolean(default=False)) is False
 
 
+############################################################
+# Request cache
+############################################################
+class RequestCache(object):
+    """Memoize the computations done several times during a request (for
+    example for each item of a Feed_View). The cache is stored in the
+    context so it is dropped at the end of the request.
+
+    The hits and misses are counted by name of computation.
+    """
+
+    def __init__(self):
+        self.values = {}
+        self.hits = {}
+        self.misses = {}
+
+
+    def get(self, name, key, function, *args):
+        """Return function(*args), computed once by (name, key).
+        """
+        key = (name, key)
+        if key in self.values:
+            self.hits[name] = self.hits.get(name, 0) + 1
+            return self.values[key]
+
+        self.misses[name] = self.misses.get(name, 0) + 1
+        value = function(*args)
+        # A generator can only be consumed once
+        if type(value) is GeneratorType:
+            value = list(value)
+        self.values[key] = value
+        return value
+
+
+    def get_stats(self):
+        """Return {name: (hits, misses)}
+        """
+        names = set(self.hits) | set(self.misses)
+        return dict([ (name, (self.hits.get(name, 0),
+                              self.misses.get(name, 0)))
+                      for name in names ])
+
+
+
+def get_request_cache(context):
+    cache = getattr(context, 'itws_request_cache', None)
+    if cache is None:
+        cache = RequestCache()
+        context.itws_request_cache = cache
+    return cache
+
+
+############################################################
+# Access control in the catalog
+############################################################
+def get_view_state(resource):
+    """Return the state which drives the view permission of the resource.
+    Resources which are not WorkflowAware are always public.
+    """
+    if isinstance(resource, WorkflowAware):
+        return resource.get_statename()
+    return 'public'
+
+
+def get_site_role(context):
+    """Return the role of the user on the current website ('admins' for
+    the administrators), None for anonymous users and users without role.
+    """
+    user = context.user
+    if user is None:
+        return None
+    site_root = context.site_root
+    if site_root.is_admin(user, site_root):
+        return 'admins'
+    return site_root.get_user_role(user.name)
+
+
+def get_allowed_to_view_query(context):
+    """Return the query which filters out the resources the user is not
+    allowed to view (see ikaaro RoleAware.is_allowed_to_view), or None if
+    the user can view all of them.
+
+    Used to apply the access control before sorting and batching the
+    results, and so to load only the resources of the batch.
+    """
+    role = get_site_role(context)
+    if role in ('members', 'reviewers', 'admins'):
+        return None
+    # Extranet, any role can view non-public resources
+    if role and context.site_root.get_security_policy() == 'extranet':
+        return None
+    return PhraseQuery('view_state', 'public')
+
+
+############################################################
+# Fragment cache
+############################################################
+fragment_caches = []
+
+def is_in_path(path, base):
+    return path == base or path.startswith('%s/' % base.rstrip('/'))
+
+
+class FragmentCache(object):
+    """Cache shared by the requests (in memory, by process).
+
+    Each entry depends on a list of paths, it is evicted when a resource
+    inside one of these paths is added, changed or removed (see
+    invalidate_fragment_caches, called on commit). A path ending with "/*"
+    only depends on the direct children of the container (e.g. a menu of
+    the website).
+    """
+
+    def __init__(self, size=1000):
+        self.size = size
+        # {key: (value, paths)}, least recently used first
+        self.values = OrderedDict()
+        # {path: set of keys}
+        self.paths = {}
+        # The paths of the index, sorted (see get_bases)
+        self.sorted_paths = []
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        fragment_caches.append(self)
+
+
+    def get(self, key, default=None):
+        self.lock.acquire()
+        try:
+            entry = self.values.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return default
+            # Least recently used at the beginning
+            self.values[key] = entry
+            self.hits += 1
+            return entry[0]
+        finally:
+            self.lock.release()
+
+
+    def _remove(self, key):
+        """Remove the entry and its key from the path index (the lock must
+        be held).
+        """
+        entry = self.values.pop(key, None)
+        if entry is None:
+            return
+        for path in entry[1]:
+            keys = self.paths.get(path)
+            if keys is None:
+                continue
+            keys.discard(key)
+            if not keys:
+                del self.paths[path]
+                index = bisect_left(self.sorted_paths, path)
+                del self.sorted_paths[index]
+
+
+    def set(self, key, value, paths):
+        paths = [ str(path) for path in paths ]
+        self.lock.acquire()
+        try:
+            self._remove(key)
+            self.values[key] = (value, paths)
+            for path in paths:
+                keys = self.paths.get(path)
+                if keys is None:
+                    keys = self.paths[path] = set()
+                    insort(self.sorted_paths, path)
+                keys.add(key)
+            # Evict the least recently used
+            while len(self.values) > self.size:
+                self._remove(next(iter(self.values)))
+        finally:
+            self.lock.release()
+
+
+    def get_bases(self, path):
+        """Return the paths of the index containing the given path (its
+        containers and the children of its container) or inside it (the
+        lock must be held).
+        """
+        paths = self.paths
+        bases = []
+        if path != '/':
+            # The children of the container
+            children = '%s/*' % path.rsplit('/', 1)[0]
+            if children in paths:
+                bases.append(children)
+        base = path
+        while True:
+            if base in paths:
+                bases.append(base)
+            if base == '/':
+                break
+            base = base.rsplit('/', 1)[0] or '/'
+        sorted_paths = self.sorted_paths
+        prefix = '%s/' % path.rstrip('/')
+        index = bisect_left(sorted_paths, prefix)
+        while (index < len(sorted_paths)
+               and sorted_paths[index].startswith(prefix)):
+            bases.append(sorted_paths[index])
+            index += 1
+        return bases
+
+
+    def invalidate(self, path):
+        path = str(path)
+        self.lock.acquire()
+        try:
+            # The resource is inside the path or the path is moved/removed
+            for base in self.get_bases(path):
+                for key in list(self.paths.get(base, ())):
+                    self._remove(key)
+        finally:
+            self.lock.release()
+
+
+    def clear(self):
+        self.lock.acquire()
+        try:
+            self.values.clear()
+            self.paths.clear()
+            del self.sorted_paths[:]
+        finally:
+            self.lock.release()
+
+
+
+# Above this number of changed paths, clear the fragment caches
+fragment_caches_max_changes = 1000
+
+def invalidate_fragment_caches(paths):
+    for cache in fragment_caches:
+        if len(paths) > fragment_caches_max_changes:
+            cache.clear()
+            continue
+        for path in paths:
+            cache.invalidate(path)
+
+
+############################################################
+# Singleton resources of the websites
+############################################################
+class SiteResourcesCache(object):
+    """Paths of the singleton resources of every website which are
+    searched (news folder, old repository), in memory, by process.
+
+    A resource is found once by website, then its path is kept until a
+    resource of its class, or one of its containers, is added, moved or
+    removed inside the website (see invalidate, called on commit).
+    """
+
+    # Above this number of added, moved or removed resources, forget the
+    # resources of the websites without looking at their formats
+    max_changes = 1000
+
+    def __init__(self):
+        # {site_root path: {name: (path or None, class_id)}}
+        self.sites = {}
+        # Not held while the resources are loaded
+        self.lock = Lock()
+
+
+    def get_resource(self, site_root, name, class_id, function, *args):
+        """Return the resource "name" of the website, "function" is called
+        with the given arguments to find it (or None) the first time.
+        """
+        site_path = str(site_root.get_canonical_path())
+        self.lock.acquire()
+        try:
+            entry = self.sites.get(site_path, {}).get(name)
+        finally:
+            self.lock.release()
+        if entry is not None:
+            path = entry[0]
+            if path is None:
+                return None
+            resource = site_root.get_resource(path, soft=True)
+            # Moved or removed before the commit
+            if resource is not None:
+                return resource
+
+        resource = function(*args)
+        path = None
+        if resource is not None:
+            path = str(resource.get_canonical_path())
+        self.lock.acquire()
+        try:
+            self.sites.setdefault(site_path, {})[name] = (path, class_id)
+        finally:
+            self.lock.release()
+        return resource
+
+
+    def get_values(self, catalog, paths):
+        """Return the formats {path: class_id} of the resources of the
+        given paths, as indexed in the catalog, None if there are too
+        many paths.
+        """
+        if not self.sites or not paths:
+            return {}
+        if len(paths) > self.max_changes:
+            return None
+        query = OrQuery(*[ PhraseQuery('abspath', x) for x in paths ])
+        return dict([ (x.abspath, x.format)
+                      for x in catalog.search(query).get_documents() ])
+
+
+    def invalidate(self, paths, old_values, new_values):
+        """Forget the resources of the websites of the given added, moved
+        or removed paths, if their class matches ("old_values" and
+        "new_values" are the values of get_values before and after the
+        commit) or if they contain a kept path.
+        """
+        formats = {}
+        for values in (old_values, new_values):
+            if values is None:
+                # Too many changes
+                formats = None
+                break
+            for path, class_id in values.iteritems():
+                formats.setdefault(path, set()).add(class_id)
+
+        self.lock.acquire()
+        try:
+            for site_path, entries in self.sites.items():
+                for path in paths:
+                    if not is_in_path(path, site_path):
+                        continue
+                    if formats is None:
+                        entries.clear()
+                        break
+                    class_ids = formats.get(path, ())
+                    for name, entry in entries.items():
+                        entry_path, class_id = entry
+                        if class_id in class_ids or (
+                                entry_path and is_in_path(entry_path, path)):
+                            del entries[name]
+        finally:
+            self.lock.release()
+
+
+    def clear(self):
+        self.lock.acquire()
+        try:
+            self.sites.clear()
+        finally:
+            self.lock.release()
+
+
+site_resources_cache = SiteResourcesCache()
+
+
 ############################################################
 # Resource with cache
 ############################################################
+class MemoryCacheStorage(object):
+    """Storage of ResourceWithCache, in memory (by process), the least
+    recently used entries are evicted.
+    """
+
+    def __init__(self, size=1000):
+        self.size = size
+        self.entries = OrderedDict()
+        self.lock = Lock()
+
+
+    def get(self, resource, key):
+        self.lock.acquire()
+        try:
+            entry = self.entries.pop(key, None)
+            if entry is not None:
+                self.entries[key] = entry
+            return entry
+        finally:
+            self.lock.release()
+
+
+    def set(self, resource, key, entry):
+        self.lock.acquire()
+        try:
+            self.entries.pop(key, None)
+            self.entries[key] = entry
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+        finally:
+            self.lock.release()
+
+
+
+class DiskCacheStorage(object):
+    """Storage of ResourceWithCache, on disk, shared by the processes of
+    the instance: <instance>/cache/<name>/<md5 of the key>
+
+    The last "size" entries are also kept in memory, with the inode and
+    mtime of their file: they are loaded again only when another process
+    wrote them.
+    """
+
+    def __init__(self, name, size=0):
+        self.name = name
+        self.size = size
+        # {path: (inode, mtime, entry)}, least recently used first
+        self.entries = OrderedDict()
+        self.lock = Lock()
+
+
+    def get_path(self, resource, key):
+        database = resource.metadata.database
+        path = dirname(database.path.rstrip('/'))
+        return join(path, 'cache', self.name, md5(key).hexdigest())
+
+
+    def get_memory_entry(self, path, version):
+        self.lock.acquire()
+        try:
+            value = self.entries.pop(path, None)
+            if value is None or value[:2] != version:
+                return None
+            # Least recently used at the beginning
+            self.entries[path] = value
+            return value[2]
+        finally:
+            self.lock.release()
+
+
+    def set_memory_entry(self, path, version, entry):
+        self.lock.acquire()
+        try:
+            self.entries.pop(path, None)
+            self.entries[path] = version + (entry,)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+        finally:
+            self.lock.release()
+
+
+    def get(self, resource, key):
+        path = self.get_path(resource, key)
+        try:
+            info = stat(path)
+        except OSError:
+            return None
+        # The file is replaced on every write (see set)
+        version = (info.st_ino, info.st_mtime)
+        if self.size:
+            entry = self.get_memory_entry(path, version)
+            if entry is not None:
+                return entry
+        try:
+            with open(path, 'rb') as cache_file:
+                entry = loads(cache_file.read())
+        except Exception:
+            log_warning('Error loading cache %s\n\n%s'
+                        % (path, format_exc()), domain='itws')
+            return None
+        if self.size:
+            self.set_memory_entry(path, version, entry)
+        return entry
+
+
+    def set(self, resource, key, entry):
+        path = self.get_path(resource, key)
+        data = dumps(entry, HIGHEST_PROTOCOL)
+        try:
+            if not exists(dirname(path)):
+                makedirs(dirname(path))
+            # Atomic for the readers
+            tmp_path = '%s.%s' % (path, md5(data).hexdigest())
+            with open(tmp_path, 'wb') as cache_file:
+                cache_file.write(data)
+            rename(tmp_path, path)
+            if self.size:
+                info = stat(path)
+                self.set_memory_entry(path, (info.st_ino, info.st_mtime),
+                                      entry)
+        except (IOError, OSError):
+            log_warning('Error saving cache %s\n\n%s'
+                        % (path, format_exc()), domain='itws')
+
+
+# Default storage
+memory_cache_storage = MemoryCacheStorage()
+# {class_id: {'hits': 0, 'misses': 0, 'refreshes': 0, 'errors': 0}}
+cache_counters = {}
+# Single flight: {key: Event} of the running updates
+cache_updates = {}
+# {key: entry} updated in background, stored by the next request
+cache_results = {}
+cache_updates_lock = Lock()
+
+
+def get_cache_counters():
+    return dict([ (x, dict(y)) for x, y in cache_counters.iteritems() ])
+
+
+
 class ResourceWithCache(DBResource):
-    """Resource with cache inside the metadata handler"""
+    """Resource with a cache of the data computed by "_update_data" (i.e.
+    downloaded from a remote service), kept in "cache_storage".
 
+    The data is updated in a background thread, only one update by
+    resource runs at the same time.  Stale data is sent at once, when
+    there is no data the request waits for the update at most
+    "cache_timeout" seconds.  The thread does not use the database:
+    "_update_data" is called on a copy of the resource with the values
+    returned by "get_update_arguments" (read in the request), the
+    requests store the result.
+    """
+
+    # Time to live of the data in seconds, may be changed by resource
+    # with the 'cache_ttl' property
+    cache_ttl = 300
+    cache_storage = memory_cache_storage
+    # Seconds to wait for the first update of the data
+    cache_timeout = 10
 
-    def __init__(self, metadata):
-        DBResource.__init__(self, metadata)
-        # Add cache API
-        timestamp = getattr(metadata, 'timestamp', None)
-        # If timestamp is None, the metadata handler could not exists on
-        # filesystem
-        # -> make_resource, check if the metadata is already loaded before
-        # setting the cache properties
-        if timestamp and getattr(metadata, 'cache_mtime', None) is None:
-            metadata.cache_mtime = None
-            metadata.cache_data = None
-            metadata.cache_errors = None
+
+    def get_update_arguments(self):
+        """Return the values "_update_data" needs (i.e. the URI and the
+        properties), read in the request.
+        """
+        return ()
 
 
     def _update_data(self):
+        """Return the data and the errors to display. Called in a thread,
+        outside of the request, on a copy of the resource: the values of
+        "get_update_arguments" are in "self.update_arguments".
+        """
         raise NotImplementedError
 
 
+    def get_cache_ttl(self):
+        if 'cache_ttl' in self.class_schema:
+            ttl = self.get_property('cache_ttl')
+            if ttl:
+                return ttl
+        return self.cache_ttl
+
+
+    def get_cache_key(self):
+        return str(self.get_abspath())
+
+
+    def get_cache_version(self):
+        # The data depends on the properties
+        return getattr(self.metadata, 'timestamp', None)
+
+
+    def get_cache_entry(self, key):
+        """Return the entry (version, mtime, data, errors) of the cache if
+        it was computed with the current properties.
+        """
+        entry = self.cache_storage.get(self, key)
+        if entry is None or entry[0] != self.get_cache_version():
+            return None
+        return entry
+
+
+    @classmethod
+    def count_cache(cls, name):
+        counters = cache_counters.setdefault(cls.class_id,
+            {'hits': 0, 'misses': 0, 'refreshes': 0, 'errors': 0})
+        counters[name] += 1
+
+
+    def update_cache(self, key):
+        """Start the update of the cached data in a background thread,
+        unless an update is running, return the event set at the end of
+        the update.
+        """
+        cache_updates_lock.acquire()
+        try:
+            event = cache_updates.get(key)
+            if event is not None:
+                return event
+            event = cache_updates[key] = Event()
+        finally:
+            cache_updates_lock.release()
+
+        # The copy is only used by the thread
+        resource = copy(self)
+        resource.update_arguments = self.get_update_arguments()
+        args = (resource, key, event, self.get_cache_version())
+        thread = Thread(target=run_cache_update, args=args)
+        thread.daemon = True
+        thread.start()
+        return event
+
+
+    def store_cache_result(self, key):
+        """Store the data updated in background, if any.
+        """
+        cache_updates_lock.acquire()
+        try:
+            entry = cache_results.pop(key, None)
+        finally:
+            cache_updates_lock.release()
+        if entry is None or entry[0] != self.get_cache_version():
+            # The properties changed during the update
+            return
+        version, mtime, data, errors = entry
+        old_entry = self.get_cache_entry(key)
+        if errors and old_entry is not None:
+            # Keep the last data, retry after the TTL
+            version, old_mtime, data, errors = old_entry
+            entry = (version, mtime, data, errors)
+        self.cache_storage.set(self, key, entry)
+
+
     def get_cached_data(self):
-        # Download or send the cache ??
-        metadata = self.metadata
-        now = datetime.now()
-        cache_mtime = metadata.cache_mtime
-        update_delta = timedelta(minutes=5) # 5 minutes
-        if (cache_mtime is None or
-            now - cache_mtime > update_delta):
-            print u'UPDATE CACHE'
-            self._update_data()
-
-        return metadata.cache_data, metadata.cache_errors
+        key = self.get_cache_key()
+        self.store_cache_result(key)
+        entry = self.get_cache_entry(key)
+        if entry is None:
+            # Nothing to send, wait for the update
+            self.count_cache('misses')
+            event = self.update_cache(key)
+            event.wait(self.cache_timeout)
+            self.store_cache_result(key)
+            entry = self.get_cache_entry(key)
+            if entry is None:
+                return None, None
+        else:
+            self.count_cache('hits')
+            mtime = entry[1]
+            ttl = timedelta(seconds=self.get_cache_ttl())
+            if datetime.now() - mtime > ttl:
+                # Send the stale data, update in background
+                self.update_cache(key)
+
+        version, mtime, data, errors = entry
+        return data, errors
+
+
+
+def run_cache_update(resource, key, event, version):
+    """Update the data of a ResourceWithCache (see update_cache), outside
+    of the request: the result is stored by the next request.
+    """
+    entry = None
+    try:
+        data, errors = resource._update_data()
+        entry = (version, datetime.now(), data, errors)
+        resource.count_cache('refreshes')
+    except Exception:
+        resource.count_cache('errors')
+        log_warning('Error updating cache %s\n\n%s' % (key, format_exc()),
+                    domain='itws')
+    finally:
+        cache_updates_lock.acquire()
+        try:
+            del cache_updates[key]
+            if entry is not None:
+                cache_results[key] = entry
+        finally:
+            cache_updates_lock.release()
+        event.set()
 
 
 
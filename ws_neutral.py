@@ -48,7 +48,7 @@ from ikaaro.website import WebSite
 # Import from itws
 from OPML import RssFeeds
 from about import AboutITWS
-from bar import HTMLContent, Website_BarAware, Section
+from bar import HTMLContent, Repository, Website_BarAware, Section
 from control_panel import CPEdit404, CPEditRobotsTXT, CPFOSwitchMode
 from control_panel import CPEditTags, CPDBResource_CommitLog
 from control_panel import CPManageHomePageMedia, ITWS_ControlPanel
@@ -60,6 +60,7 @@ from robots_txt import RobotsTxt
 from sitemap import SiteMap
 from tags import TagsAware, TagsFolder
 from theme import Theme
+from utils import site_resources_cache
 from views import Website_NewResource
 from webpage import WebPage
 from ws_neutral_views import NeutralWS_Edit, NeutralWS_RSS
@@ -89,7 +90,7 @@ class NeutralWS(Website_BarAware, WebSite):
     """
 
     class_id = 'neutral'
-    class_version = '20101015'
+    class_version = '20110301'
     class_title = MSG(u'ITWS Web Site')
     class_description = MSG(u'Create a new ITWS Web Site')
     class_icon16 = 'common/icons/16x16/itws-website.png'
@@ -233,15 +234,24 @@ class NeutralWS(Website_BarAware, WebSite):
         return types + [Section, RssFeeds]
 
 
+    ###########################################################################
+    # Singleton resources
+    ###########################################################################
     def get_repository(self, soft=False):
-        # Backward compatibility
-        repository = self.get_resource('right-depot', soft=True)
+        # Backward compatibility, the old name is looked up once
+        repository = site_resources_cache.get_resource(self, 'right-depot',
+            Repository.class_id, self.get_resource, 'right-depot', True)
         if repository:
             return repository
         return self.get_resource('repository', soft=soft)
 
 
     def get_news_folder(self, context):
+        return site_resources_cache.get_resource(self, 'news',
+            self.newsfolder_class.class_id, self._get_news_folder, context)
+
+
+    def _get_news_folder(self, context):
         # News folder MUST be in root '/foo'
         abspath = self.get_canonical_path()
         query = [get_base_path_query(abspath, depth=1),
@@ -258,6 +268,14 @@ class NeutralWS(Website_BarAware, WebSite):
         return None
 
 
+    def get_tags_folder(self, soft=False):
+        return self.get_resource('tags', soft=soft)
+
+
+    def get_turning_footer(self):
+        return self.get_resource('theme/turning-footer', soft=True)
+
+
     def get_article_class(self):
         # ContentBarItem_Articles_View API
         return WebPage
@@ -489,6 +507,15 @@ class NeutralWS(Website_BarAware, WebSite):
                 resource.metadata.set_property('pub_datetime', utc_datetime)
 
 
+    def update_20110301(self):
+        """Index the 'view_state' field
+        Feed views and RSS filter the items on it"""
+        database = get_context().database
+        # traverse_resources yields the website itself first
+        for resource in self.traverse_resources():
+            database.change_resource(resource)
+
+
 
 ############################################################
 # Register